@@ -0,0 +1,192 @@
+import argparse
+import queue
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime
+
+import serial
+
+# High-rate capture of the step_fct stream ("<device time s>, <temp C>" per line).
+# Serial input is drained in bulk, split into lines in batches and stamped with the
+# host's monotonic receive time; a writer thread appends the samples to a chunked
+# binary file so the read loop never waits on the disk.
+#
+# File layout: b'STPC' + version (uint16), then chunks of
+#   b'CHNK' + count (uint32) + host times (float64[count]) + device times (float64[count]) + temps (float32[count])
+
+BAUDRATE = 115200
+BANNER = b'Waiting...'
+BANNER_TIMEOUT_S = 10
+SAMPLE_PERIOD_S = 0.25   # SAMPLE_RATE_ms in step_fct.ino
+READ_SIZE = 4096
+CHUNK_SAMPLES = 1024
+
+FILE_MAGIC = b'STPC'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<4sH')
+CHUNK_HEADER = struct.Struct('<4sI')
+CHUNK_MAGIC = b'CHNK'
+
+
+class CaptureStats:
+    def __init__(self):
+        self.samples = 0
+        self.malformed = 0
+        self.dropped = 0
+        self.sensor_faults = 0
+        self.batches = 0
+        self.max_batch_lines = 0
+        self.last_device_time = None
+
+    def report(self):
+        print(f'{self.samples} samples in {self.batches} batches (largest batch {self.max_batch_lines} lines)')
+        print(f'{self.dropped} dropped, {self.malformed} malformed, {self.sensor_faults} sensor faults')
+
+
+def chunk_bytes(host_times, device_times, temps):
+    return CHUNK_HEADER.pack(CHUNK_MAGIC, len(host_times)) + host_times.tobytes() + device_times.tobytes() + temps.tobytes()
+
+def writer_loop(path, samples_queue):
+    with open(path, 'wb') as file:
+        file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        while True:
+            chunk = samples_queue.get()
+            if chunk is None:
+                break
+            file.write(chunk_bytes(*chunk))
+            file.flush()
+
+def parse_batch(lines, receive_time, stats, host_times, device_times, temps):
+    stats.batches += 1
+    stats.max_batch_lines = max(stats.max_batch_lines, len(lines))
+
+    for line in lines:
+        fields = line.strip().split(b',')
+        if len(fields) != 2:
+            stats.malformed += 1
+            continue
+        try:
+            device_time = float(fields[0])
+            temp = float(fields[1])
+        except ValueError:
+            stats.malformed += 1
+            continue
+
+        # The firmware reports -1 (open thermocouple) and -2 (bad read) as temperatures
+        if temp < 0:
+            stats.sensor_faults += 1
+
+        if stats.last_device_time is not None:
+            gap = device_time - stats.last_device_time
+            if gap > 1.5 * SAMPLE_PERIOD_S:
+                stats.dropped += round(gap / SAMPLE_PERIOD_S) - 1
+        stats.last_device_time = device_time
+
+        host_times.append(receive_time)
+        device_times.append(device_time)
+        temps.append(temp)
+        stats.samples += 1
+
+def wait_for_banner(port):
+    deadline = time.monotonic() + BANNER_TIMEOUT_S
+    while time.monotonic() < deadline:
+        if BANNER in port.readline():
+            return True
+    return False
+
+def capture(port, path):
+    stats = CaptureStats()
+    samples_queue = queue.Queue()
+    writer = threading.Thread(target=writer_loop, args=(path, samples_queue), daemon=True)
+    writer.start()
+
+    pending = bytearray()
+    host_times, device_times, temps = array('d'), array('d'), array('f')
+    start = time.monotonic()
+
+    try:
+        while True:
+            data = port.read(port.in_waiting or 1)
+            if len(data) == 0:
+                continue
+            receive_time = time.monotonic() - start
+
+            pending += data
+            end = pending.rfind(b'\n')
+            if end < 0:
+                continue
+            lines = pending[:end].split(b'\n')
+            del pending[:end + 1]
+
+            parse_batch(lines, receive_time, stats, host_times, device_times, temps)
+
+            if len(host_times) >= CHUNK_SAMPLES:
+                samples_queue.put((host_times, device_times, temps))
+                host_times, device_times, temps = array('d'), array('d'), array('f')
+    except KeyboardInterrupt:
+        print('Capture stopped')
+    except serial.SerialException as e:
+        print(f'Serial error, capture stopped: {e}')
+
+    if len(pending.strip()) > 0:
+        stats.malformed += 1
+    if len(host_times) > 0:
+        samples_queue.put((host_times, device_times, temps))
+    samples_queue.put(None)
+    writer.join()
+
+    return stats
+
+def read_capture(path):
+    host_times, device_times, temps = array('d'), array('d'), array('f')
+    with open(path, 'rb') as file:
+        magic, version = FILE_HEADER.unpack(file.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC or version > FILE_VERSION:
+            raise ValueError(f'{path} is not a capture file')
+
+        while True:
+            header = file.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                break
+            magic, count = CHUNK_HEADER.unpack(header)
+            if magic != CHUNK_MAGIC:
+                raise ValueError(f'Corrupt chunk in {path}')
+            host_times.frombytes(file.read(8 * count))
+            device_times.frombytes(file.read(8 * count))
+            temps.frombytes(file.read(4 * count))
+
+    return host_times, device_times, temps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Capture the step response stream from step_fct')
+    parser.add_argument('--port', default='COM3')
+    parser.add_argument('--output', default=f'step_{datetime.now().strftime("%y-%m-%d__%H-%M-%S")}.cap')
+    parser.add_argument('--to-csv', metavar='CAPTURE', help='convert a capture file to CSV and exit')
+    args = parser.parse_args()
+
+    if args.to_csv:
+        host_times, device_times, temps = read_capture(args.to_csv)
+        csv_name = args.to_csv.rsplit('.', 1)[0] + '.csv'
+        with open(csv_name, 'w') as file:
+            file.write('Host time (s), Device time (s), Temperature (C)\n')
+            for row in zip(host_times, device_times, temps):
+                file.write(f'{row[0]:.6f}, {row[1]}, {row[2]}\n')
+        print(f'{len(temps)} samples written to {csv_name}')
+        exit()
+
+    ser = serial.Serial(port=args.port, baudrate=BAUDRATE, timeout=1)
+    if not wait_for_banner(ser):
+        print('No banner received from step_fct')
+        exit()
+
+    input("Waiting for you")
+    ser.reset_input_buffer()
+    ser.write(b'\n')
+
+    stats = capture(ser, args.output)
+    ser.close()
+    stats.report()
+    print(f'Saved {args.output}')
@@ -0,0 +1,351 @@
+import argparse
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from toaster_envelope import ENVELOPE_SCHEMA, Envelope, record_run
+from toaster_profile import profile_hash, profile_name
+import toaster_trace as trace
+
+ARCHIVE_DIR = 'runs'
+CATALOG_NAME = 'archive.db'
+SAMPLES_DIR = 'archive'
+CHUNK_SAMPLES = 600
+
+# One sample: host time (ms since start), then the 5 values returned by Toaster.read():
+# ADC reading, ADC voltage (mV), temperature (mdegC), profile step, desired temperature (mdegC)
+SAMPLE_FORMAT = struct.Struct('<ihhihi')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    profile_name TEXT,
+    profile_hash TEXT,
+    port TEXT,
+    gain REAL,
+    hysteresis REAL,
+    calibration_temp REAL,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    n_samples INTEGER DEFAULT 0,
+    peak_temp REAL,
+    max_overshoot REAL,
+    max_undershoot REAL,
+    mean_abs_error REAL,
+    rms_error REAL,
+    sample_file TEXT,
+    calibration TEXT
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    seq INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    n_samples INTEGER NOT NULL,
+    t_start REAL NOT NULL,
+    t_end REAL NOT NULL,
+    PRIMARY KEY (run_id, seq)
+);
+CREATE INDEX IF NOT EXISTS runs_by_profile ON runs(profile_hash, start_time);
+CREATE INDEX IF NOT EXISTS runs_by_name ON runs(profile_name, start_time);
+CREATE INDEX IF NOT EXISTS runs_by_time ON runs(start_time);
+'''
+
+# Columns added after the first catalogs were created, and their types
+ADDED_COLUMNS = {
+    'calibration': 'TEXT',
+}
+
+
+class RunWriter:
+    def __init__(self, archive, run_id, sample_path, profile_hash=None, profile_name=None):
+        self.archive = archive
+        self.run_id = run_id
+        self.sample_path = sample_path
+        self.profile_hash = profile_hash
+        self.profile_name = profile_name
+        self.file = open(sample_path, 'ab')
+        self.pending = []
+        self.seq = 0
+        self.n_samples = 0
+        self.finished = False
+
+        # Summary metrics, updated as samples arrive so finishing a run never re-reads it
+        self.peak_temp = None
+        self.max_overshoot = None
+        self.max_undershoot = None
+        self.abs_error_sum = 0.0
+        self.sq_error_sum = 0.0
+        self.n_active = 0
+
+        # This run's share of the profile's envelope, merged into it by finish()
+        self.envelope = Envelope() if profile_hash is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.finish()
+
+    def add(self, time_s, vals):
+        adc, voltage_mv, temp_mdegc, step, desired_mdegc = vals[:5]
+        self.pending.append((int(time_s * 1000), adc, voltage_mv, temp_mdegc, step, desired_mdegc))
+        self.n_samples += 1
+
+        temp_degc = temp_mdegc / 1000.0
+        if self.peak_temp is None or temp_degc > self.peak_temp:
+            self.peak_temp = temp_degc
+        if self.envelope is not None:
+            self.envelope.add(time_s, temp_degc)
+
+        # Only samples taken while the profile is running are judged against the setpoint
+        if step >= 0:
+            error_degc = (temp_mdegc - desired_mdegc) / 1000.0
+            if self.max_overshoot is None or error_degc > self.max_overshoot:
+                self.max_overshoot = error_degc
+            if self.max_undershoot is None or -error_degc > self.max_undershoot:
+                self.max_undershoot = -error_degc
+            self.abs_error_sum += abs(error_degc)
+            self.sq_error_sum += error_degc * error_degc
+            self.n_active += 1
+
+        if len(self.pending) >= CHUNK_SAMPLES:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        with trace.span('archive flush', len(self.pending)):
+            raw = b''.join(SAMPLE_FORMAT.pack(*sample) for sample in self.pending)
+            packed = zlib.compress(raw)
+            offset = self.file.tell()
+            self.file.write(packed)
+            self.file.flush()
+
+        with self.archive.db:
+            self.archive.db.execute(
+                'INSERT INTO chunks (run_id, seq, offset, length, n_samples, t_start, t_end) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.run_id, self.seq, offset, len(packed), len(self.pending),
+                 self.pending[0][0] / 1000.0, self.pending[-1][0] / 1000.0))
+        self.seq += 1
+        self.pending = []
+
+    def metrics(self):
+        mean_abs_error = None
+        rms_error = None
+        if self.n_active > 0:
+            mean_abs_error = self.abs_error_sum / self.n_active
+            rms_error = (self.sq_error_sum / self.n_active) ** 0.5
+
+        return {
+            'n_samples': self.n_samples,
+            'peak_temp': self.peak_temp,
+            'max_overshoot': self.max_overshoot,
+            'max_undershoot': self.max_undershoot,
+            'mean_abs_error': mean_abs_error,
+            'rms_error': rms_error,
+        }
+
+    def finish(self, end_time=None):
+        if self.finished:
+            return
+        self.flush()
+        self.file.close()
+        self.finished = True
+
+        metrics = self.metrics()
+        with self.archive.db:
+            self.archive.db.execute(
+                'UPDATE runs SET end_time = ?, n_samples = ?, peak_temp = ?, max_overshoot = ?, '
+                'max_undershoot = ?, mean_abs_error = ?, rms_error = ? WHERE id = ?',
+                (time.time() if end_time is None else end_time, metrics['n_samples'], metrics['peak_temp'], metrics['max_overshoot'],
+                 metrics['max_undershoot'], metrics['mean_abs_error'], metrics['rms_error'], self.run_id))
+            if self.envelope is not None:
+                record_run(self.archive.db, self.profile_hash, self.envelope, self.profile_name)
+
+
+class RunArchive:
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        self.samples_dir = os.path.join(directory, SAMPLES_DIR)
+        os.makedirs(self.samples_dir, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(directory, CATALOG_NAME))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA + ENVELOPE_SCHEMA)
+
+        existing = [row['name'] for row in self.db.execute('PRAGMA table_info(runs)')]
+        with self.db:
+            for name, column_type in ADDED_COLUMNS.items():
+                if name not in existing:
+                    self.db.execute(f'ALTER TABLE runs ADD COLUMN {name} {column_type}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def begin_run(self, steps=None, name='', port=None, gain=None, hysteresis=None, calibration_temp=None, start_time=None,
+                  calibration=None):
+        hash_hex = profile_hash(steps) if steps else None
+        start_time = time.time() if start_time is None else start_time
+
+        with self.db:
+            cursor = self.db.execute(
+                'INSERT INTO runs (profile_name, profile_hash, port, gain, hysteresis, calibration_temp, start_time, calibration) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, hash_hex, port, gain, hysteresis, calibration_temp, start_time, calibration))
+            run_id = cursor.lastrowid
+
+            # The run id makes the file name unique, even for runs started in the same second
+            sample_file = f'run_{run_id:06d}_{name}.bin'
+            self.db.execute('UPDATE runs SET sample_file = ? WHERE id = ?', (sample_file, run_id))
+
+        return RunWriter(self, run_id, os.path.join(self.samples_dir, sample_file), hash_hex, name)
+
+    def replace_samples(self, run_id, samples, calibration=None):
+        # Rewrites a run's samples (e.g. recalibrated temperatures) to a new file and recomputes its metrics
+        run = self.get_run(run_id)
+        old_path = os.path.join(self.samples_dir, run['sample_file'])
+        sample_file = f"run_{run_id:06d}_{run['profile_name']}.{calibration or 'raw'}.bin"
+        if sample_file == run['sample_file']:
+            sample_file = sample_file[:-len('.bin')] + f'.{int(time.time())}.bin'
+        new_path = os.path.join(self.samples_dir, sample_file)
+        if os.path.exists(new_path):
+            os.remove(new_path)
+
+        with self.db:
+            self.db.execute('DELETE FROM chunks WHERE run_id = ?', (run_id,))
+            self.db.execute('UPDATE runs SET sample_file = ?, calibration = ? WHERE id = ?',
+                            (sample_file, calibration, run_id))
+
+        # The run is already part of its profile's envelope, so the rewrite doesn't update it
+        writer = RunWriter(self, run_id, new_path)
+        for sample in samples:
+            writer.add(sample[0], sample[1:])
+        writer.finish(end_time=run['end_time'])
+
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    def get_run(self, run_id):
+        return self.db.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+
+    def find_runs(self, profile=None, port=None, since=None, until=None, min_overshoot=None, max_rms_error=None):
+        # Answered from the catalog alone, the sample files are never opened
+        query = 'SELECT * FROM runs WHERE 1'
+        params = []
+
+        if profile is not None:
+            query += ' AND (profile_name = ? OR profile_hash = ?)'
+            params += [profile_name(profile), profile]
+        if port is not None:
+            query += ' AND port = ?'
+            params.append(port)
+        if since is not None:
+            query += ' AND start_time >= ?'
+            params.append(to_timestamp(since))
+        if until is not None:
+            query += ' AND start_time < ?'
+            params.append(to_timestamp(until))
+        if min_overshoot is not None:
+            query += ' AND max_overshoot > ?'
+            params.append(min_overshoot)
+        if max_rms_error is not None:
+            query += ' AND rms_error <= ?'
+            params.append(max_rms_error)
+
+        query += ' ORDER BY start_time'
+        return self.db.execute(query, params).fetchall()
+
+    def load_samples(self, run_id, t_from=None, t_to=None):
+        # Returns [time (s), ADC reading, ADC voltage, temperature, profile step, desired temperature] rows,
+        # with the last 5 values in the same units as Toaster.read().
+        # Only chunks overlapping [t_from, t_to] are read and decompressed.
+        run = self.get_run(run_id)
+        if run is None:
+            return []
+
+        query = 'SELECT offset, length FROM chunks WHERE run_id = ?'
+        params = [run_id]
+        if t_from is not None:
+            query += ' AND t_end >= ?'
+            params.append(t_from)
+        if t_to is not None:
+            query += ' AND t_start <= ?'
+            params.append(t_to)
+        query += ' ORDER BY seq'
+
+        samples = []
+        with open(os.path.join(self.samples_dir, run['sample_file']), 'rb') as file:
+            for offset, length in self.db.execute(query, params).fetchall():
+                file.seek(offset)
+                raw = zlib.decompress(file.read(length))
+                for sample in SAMPLE_FORMAT.iter_unpack(raw):
+                    time_s = sample[0] / 1000.0
+                    if (t_from is not None and time_s < t_from) or (t_to is not None and time_s > t_to):
+                        continue
+                    samples.append([time_s, *sample[1:]])
+        return samples
+
+
+def start_run_archiver(steps=None, name='', directory=ARCHIVE_DIR, **run_info):
+    # Archives every (time s, Toaster.read() values) put on the returned queue as one run, until None is put.
+    # The archive is opened on the writer thread, sqlite connections can't be shared between threads
+    samples = queue.Queue()
+
+    def write_samples():
+        with RunArchive(directory) as archive, archive.begin_run(steps, name, **run_info) as run_writer:
+            while True:
+                sample = samples.get()
+                if sample is None:
+                    break
+                run_writer.add(*sample)
+        print(f'Run archived as #{run_writer.run_id}')
+
+    thread = threading.Thread(target=write_samples, daemon=True)
+    thread.start()
+    return samples, thread
+
+def to_timestamp(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    return float(value)
+
+def format_run(run):
+    start = datetime.fromtimestamp(run['start_time']).strftime("%y-%m-%d %H:%M:%S")
+    overshoot = 'n/a' if run['max_overshoot'] is None else f"{run['max_overshoot']:.1f}"
+    rms = 'n/a' if run['rms_error'] is None else f"{run['rms_error']:.2f}"
+    return f"{run['id']:6d}  {start}  {run['profile_name']:<16} {str(run['port']):<8} " \
+           f"samples={run['n_samples']:<6} overshoot={overshoot:<6} rms={rms}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the run archive')
+    parser.add_argument('--dir', default=ARCHIVE_DIR)
+    parser.add_argument('--profile', help='profile name (e.g. basic.csv) or hash')
+    parser.add_argument('--port')
+    parser.add_argument('--since', help='ISO date, e.g. 2024-05-01')
+    parser.add_argument('--until', help='ISO date')
+    parser.add_argument('--min-overshoot', type=float, help='degrees C above the desired temperature')
+    parser.add_argument('--max-rms-error', type=float)
+    args = parser.parse_args()
+
+    with RunArchive(args.dir) as archive:
+        runs = archive.find_runs(profile=args.profile, port=args.port, since=args.since, until=args.until,
+                                 min_overshoot=args.min_overshoot, max_rms_error=args.max_rms_error)
+        for run in runs:
+            print(format_run(run))
+        print(f'{len(runs)} run(s)')
@@ -0,0 +1,299 @@
+import argparse
+import glob
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+CALIBRATION_DIR = 'calibrations'
+FILE_FORMAT = 1
+ADC_MAX = 1023
+KELVIN = 273.15
+
+# Divider used by the Steinhart-Hart fit: thermistor between the ADC pin and ground
+DEFAULT_SERIES_RESISTANCE_OHM = 10000.0
+DEFAULT_POLY_DEGREE = 3
+
+SWEEP_READS_PER_POINT = 10
+SWEEP_INTERVAL_S = 30    # of heating between points
+SWEEP_POLL_S = 0.5
+SWEEP_MAX_TEMP_DEGC = 250
+
+
+def adc_to_resistance(adc, series_resistance=DEFAULT_SERIES_RESISTANCE_OHM):
+    adc = np.clip(np.asarray(adc, dtype=np.float64), 0.5, ADC_MAX - 0.5)
+    return series_resistance * adc / (ADC_MAX - adc)
+
+
+class Calibration:
+    def __init__(self, kind, coeffs, version=1, created=None, series_resistance=DEFAULT_SERIES_RESISTANCE_OHM, points=None):
+        if kind not in ('polynomial', 'steinhart_hart'):
+            raise ValueError(f'Unknown calibration kind {kind}')
+        self.kind = kind
+        self.coeffs = [float(c) for c in coeffs]
+        self.version = version
+        self.created = created if created is not None else datetime.now().isoformat(timespec='seconds')
+        self.series_resistance = series_resistance
+        self.points = points if points is not None else []
+        # Evaluated once for every possible ADC reading, applying the calibration is then a lookup
+        self.lut = self.evaluate(np.arange(ADC_MAX + 1))
+
+    @property
+    def name(self):
+        return f'v{self.version:03d}'
+
+    def evaluate(self, adc):
+        adc = np.asarray(adc, dtype=np.float64)
+        if self.kind == 'polynomial':
+            return np.polyval(self.coeffs, adc)
+
+        log_r = np.log(adc_to_resistance(adc, self.series_resistance))
+        a, b, c = self.coeffs
+        return 1.0 / (a + b * log_r + c * log_r ** 3) - KELVIN
+
+    def apply(self, adc):
+        # Vectorized: integer readings index the lookup table, averaged readings interpolate in it
+        adc = np.asarray(adc)
+        if adc.dtype.kind in 'iu':
+            return self.lut[np.clip(adc, 0, ADC_MAX)]
+        return np.interp(adc, np.arange(ADC_MAX + 1), self.lut)
+
+    def apply_reads(self, reads):
+        # reads: block of Toaster.read() replies, the ADC reading is the first value
+        block = np.asarray(reads)
+        if len(block) == 0:
+            return np.empty(0)
+        return self.apply(block[:, 0])
+
+    def to_dict(self):
+        return {
+            'format': FILE_FORMAT,
+            'version': self.version,
+            'created': self.created,
+            'kind': self.kind,
+            'coeffs': self.coeffs,
+            'series_resistance': self.series_resistance,
+            'points': self.points,
+            'lut': [round(float(temp), 3) for temp in self.lut],
+        }
+
+    def save(self, directory=CALIBRATION_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'calibration_{self.name}.json')
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+        return path
+
+
+def load_calibration(path):
+    with open(path, 'r') as file:
+        data = json.load(file)
+    if data.get('format', 0) > FILE_FORMAT:
+        raise ValueError(f'{path} was written by a newer version of this tool')
+
+    cal = Calibration(data['kind'], data['coeffs'], version=data['version'], created=data['created'],
+                      series_resistance=data.get('series_resistance', DEFAULT_SERIES_RESISTANCE_OHM),
+                      points=data.get('points', []))
+    if 'lut' in data and len(data['lut']) == ADC_MAX + 1:
+        cal.lut = np.array(data['lut'], dtype=np.float64)
+    return cal
+
+def calibration_files(directory=CALIBRATION_DIR):
+    return sorted(glob.glob(os.path.join(directory, 'calibration_v*.json')))
+
+def latest_calibration(directory=CALIBRATION_DIR):
+    files = calibration_files(directory)
+    if len(files) == 0:
+        return None
+    return load_calibration(files[-1])
+
+def next_version(directory=CALIBRATION_DIR):
+    latest = latest_calibration(directory)
+    return 1 if latest is None else latest.version + 1
+
+def fit_polynomial(adc, ref_temps, degree=DEFAULT_POLY_DEGREE, version=1):
+    adc = np.asarray(adc, dtype=np.float64)
+    ref_temps = np.asarray(ref_temps, dtype=np.float64)
+    degree = min(degree, len(adc) - 1)
+    if degree < 1:
+        raise ValueError('At least 2 calibration points are needed')
+
+    coeffs = np.polyfit(adc, ref_temps, degree)
+    return Calibration('polynomial', coeffs, version=version, points=list(zip(adc.tolist(), ref_temps.tolist())))
+
+def fit_steinhart_hart(adc, ref_temps, series_resistance=DEFAULT_SERIES_RESISTANCE_OHM, version=1):
+    adc = np.asarray(adc, dtype=np.float64)
+    ref_temps = np.asarray(ref_temps, dtype=np.float64)
+    if len(adc) < 3:
+        raise ValueError('At least 3 calibration points are needed')
+
+    # 1/T = A + B ln(R) + C ln(R)^3, linear in A, B, C
+    log_r = np.log(adc_to_resistance(adc, series_resistance))
+    system = np.column_stack([np.ones_like(log_r), log_r, log_r ** 3])
+    coeffs, *_ = np.linalg.lstsq(system, 1.0 / (ref_temps + KELVIN), rcond=None)
+    return Calibration('steinhart_hart', coeffs, version=version, series_resistance=series_resistance,
+                       points=list(zip(adc.tolist(), ref_temps.tolist())))
+
+def fit_points(points, kind='polynomial', degree=DEFAULT_POLY_DEGREE, series_resistance=DEFAULT_SERIES_RESISTANCE_OHM, version=1):
+    adc = [point[0] for point in points]
+    ref_temps = [point[1] for point in points]
+    if kind == 'steinhart_hart':
+        return fit_steinhart_hart(adc, ref_temps, series_resistance, version=version)
+    return fit_polynomial(adc, ref_temps, degree, version=version)
+
+def residuals(cal, points):
+    points = np.asarray(points, dtype=np.float64)
+    return cal.evaluate(points[:, 0]) - points[:, 1]
+
+def ask_reference_temp():
+    while True:
+        try:
+            return float(input('Reference temperature (C) ? '))
+        except ValueError:
+            print('Input not recognized')
+
+def set_heaters(controller, on):
+    if on:
+        controller.on(is_slow=True)
+        controller.on()
+    else:
+        controller.off()
+        controller.off(is_slow=True)
+
+def read_adc(controller, n_reads):
+    return float(np.mean(np.asarray([controller.read(do_print=False) for _ in range(n_reads)])[:, 0]))
+
+def heat_for(controller, duration_s, max_temp_degc):
+    # Heats for duration_s, polling the board's own reading; False if it reached max_temp_degc first
+    set_heaters(controller, True)
+    deadline = time.monotonic() + duration_s
+    try:
+        while time.monotonic() < deadline:
+            temp_degc = controller.read(do_print=False)[2] / 1000.0
+            if temp_degc >= max_temp_degc:
+                print(f'Oven reads {temp_degc:.1f} C, stopping the sweep')
+                return False
+            time.sleep(SWEEP_POLL_S)
+        return True
+    finally:
+        set_heaters(controller, False)
+
+def collect_sweep(controller, reference=ask_reference_temp, max_temp_degc=SWEEP_MAX_TEMP_DEGC,
+                  interval_s=SWEEP_INTERVAL_S, reads_per_point=SWEEP_READS_PER_POINT):
+    # Pairs the ADC reading with a reference temperature, then heats for interval_s and repeats,
+    # until the reference or the board's own reading passes max_temp_degc. Returns [(adc, reference temp), ...]
+    # The heaters are off while the reference is entered, so the oven sits on a slow plateau however
+    # long that takes, and the ADC is averaged over reads taken just before and just after the entry.
+    points = []
+    try:
+        while True:
+            adc_before = read_adc(controller, reads_per_point)
+            ref_temp = reference()
+            adc = (adc_before + read_adc(controller, reads_per_point)) / 2.0
+            points.append((adc, ref_temp))
+            print(f'Point {len(points)}: ADC {adc:.1f} -> {ref_temp:.1f} C')
+
+            if ref_temp >= max_temp_degc or not heat_for(controller, interval_s, max_temp_degc):
+                break
+    finally:
+        set_heaters(controller, False)
+
+    return points
+
+def recalibrate_archive(archive, cal, run_ids=None):
+    # Re-processes archived runs in bulk, replacing their temperatures with ones computed from the raw ADC column
+    if run_ids is None:
+        run_ids = [run['id'] for run in archive.find_runs()]
+
+    for run_id in run_ids:
+        samples = archive.load_samples(run_id)
+        if len(samples) == 0:
+            continue
+        adc = np.asarray(samples)[:, 1].astype(np.int64)
+        temps_mdegc = np.round(cal.apply(adc) * 1000.0).astype(np.int64)
+        for sample, temp_mdegc in zip(samples, temps_mdegc.tolist()):
+            sample[3] = temp_mdegc
+        archive.replace_samples(run_id, samples, calibration=cal.name)
+    return run_ids
+
+def recalibrate_runfile(path, cal, out_path=None):
+    from toaster_runfile import RunFile, write_run
+
+    if out_path is None:
+        out_path = os.path.splitext(path)[0] + f'.{cal.name}.trun'
+
+    with RunFile(path) as run:
+        if 'adc' not in run:
+            raise ValueError(f'{path} has no ADC column to recalibrate')
+        columns = {name: np.array(run[name]) for name in run.columns}
+        meta = dict(run.meta)
+
+    columns['temp'] = cal.apply(columns['adc'])
+    meta['calibration'] = cal.name
+    write_run(out_path, columns, meta=meta)
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fit and apply multi-point temperature calibrations')
+    parser.add_argument('--dir', default=CALIBRATION_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sweep_parser = subparsers.add_parser('sweep', help='heat the oven and collect (ADC, reference) points')
+    sweep_parser.add_argument('--port', help='serial port of the toaster, found automatically by default')
+    sweep_parser.add_argument('--max-temp', type=float, default=SWEEP_MAX_TEMP_DEGC)
+    sweep_parser.add_argument('--interval', type=float, default=SWEEP_INTERVAL_S)
+
+    refit_parser = subparsers.add_parser('refit', help='refit the points of an existing calibration')
+    refit_parser.add_argument('calibration', nargs='?')
+
+    for sub in (sweep_parser, refit_parser):
+        sub.add_argument('--kind', choices=('polynomial', 'steinhart_hart'), default='polynomial')
+        sub.add_argument('--degree', type=int, default=DEFAULT_POLY_DEGREE)
+        sub.add_argument('--series-resistance', type=float, default=DEFAULT_SERIES_RESISTANCE_OHM)
+
+    archive_parser = subparsers.add_parser('archive', help='recalibrate archived runs')
+    archive_parser.add_argument('runs', nargs='*', type=int)
+    archive_parser.add_argument('--calibration')
+
+    runfile_parser = subparsers.add_parser('runfile', help='recalibrate .trun files')
+    runfile_parser.add_argument('files', nargs='+')
+    runfile_parser.add_argument('--calibration')
+
+    args = parser.parse_args()
+
+    if args.command in ('sweep', 'refit'):
+        if args.command == 'sweep':
+            from toaster_ctrl import Toaster
+            with Toaster(args.port) as controller:
+                controller.begin_ctrl()
+                points = collect_sweep(controller, max_temp_degc=args.max_temp, interval_s=args.interval)
+        else:
+            source = load_calibration(args.calibration) if args.calibration else latest_calibration(args.dir)
+            if source is None:
+                print('No calibration to refit')
+                exit()
+            points = source.points
+
+        cal = fit_points(points, kind=args.kind, degree=args.degree, series_resistance=args.series_resistance,
+                         version=next_version(args.dir))
+        errors = residuals(cal, points)
+        print(f'Fit {cal.kind}: max error {np.max(np.abs(errors)):.2f} C, rms {np.sqrt(np.mean(errors ** 2)):.2f} C')
+        print(f'Saved {cal.save(args.dir)}')
+
+    else:
+        cal = load_calibration(args.calibration) if args.calibration else latest_calibration(args.dir)
+        if cal is None:
+            print('No calibration found')
+            exit()
+
+        if args.command == 'archive':
+            from toaster_archive import RunArchive
+            with RunArchive() as archive:
+                done = recalibrate_archive(archive, cal, args.runs or None)
+            print(f'Recalibrated {len(done)} run(s) with {cal.name}')
+        else:
+            for path in args.files:
+                print(f'{path} -> {recalibrate_runfile(path, cal)}')
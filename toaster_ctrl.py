@@ -3,6 +3,8 @@ import serial
 import time
 import struct
 import threading
+import toaster_trace as trace
+from toaster_discovery import REV2, find_port
 
 serial_mutex = threading.Lock()
 
@@ -18,12 +20,14 @@ class Watchdog:
     def wakeup(self):
         while not self.end:
             if self.is_watchdoging:
-                with self.mutex:
-                    self.port.write(b'k\n')
-                    
-                    reply = self.port.read_until(b'\n')
-                    if (reply != b'ok\n'):
-                        print("Problem with Watchdog reply")
+                with trace.span('watchdog'):
+                    with self.mutex:
+                        with trace.span('serial io', b'k'):
+                            self.port.write(b'k\n')
+
+                            reply = self.port.read_until(b'\n')
+                        if (reply != b'ok\n'):
+                            print("Problem with Watchdog reply")
                         
             time.sleep(self.period)
 
@@ -45,13 +49,18 @@ class Watchdog:
         self.end = True
 
 class Toaster:
-    def __init__(self, comport='COM3'):
+    def __init__(self, comport=None):
+        # With no port given, the first rev2 board toaster_discovery finds is used
         self.comport = comport
         self.port = None
         self.watchdog = None
         self.has_begun = False
 
     def __enter__(self):
+        if self.comport is None:
+            self.comport = find_port(REV2)
+            if self.comport is None:
+                raise serial.SerialException('No toaster found, pass its port explicitly')
         self.port = serial.Serial(self.comport, baudrate = 38400, timeout=5)
         self.watchdog = Watchdog(self.port)
         return self
@@ -85,7 +94,10 @@ class Toaster:
         if self.port != None:
             self.port.close()
 
-    def send_cmd(self, byte_str, expect_ok=True):
+    def send_cmd(self, byte_str, expect_ok=True, info_lines=0):
+        # info_lines: lines the firmware prints before its reply (e.g. 'pa' echoes the point's time).
+        # They are read under the same lock so another thread can't take them as its own reply.
+        # Returns the reply, or (info lines, reply) when info_lines > 0.
         if (self.port == None) or (not self.has_begun):
             self.in_error("Port or watchdog not initialized, cannot send cmd")
             return
@@ -94,20 +106,43 @@ class Toaster:
         if out_str[-1] != b'\n':
             out_str += b'\n'
 
-        with serial_mutex:
-            self.port.write(out_str)
+        # Time between the two spans starting is spent waiting for the watchdog or another thread
+        with trace.span('send_cmd', out_str[:1]):
+            with serial_mutex:
+                with trace.span('serial io', out_str[:1]):
+                    self.port.write(out_str)
+
+                    info = [self.port.read_until(b'\n') for _ in range(info_lines)]
+                    reply = self.port.read_until(b'\n')
+                if expect_ok and reply != b'ok\n':
+                    print('Non-ok message received!!')
+                if info_lines > 0:
+                    return info, reply
+                return reply
+
+    def send_cmds(self, byte_strs):
+        # Pipelined: every command is written in one go, then one reply is read per command.
+        # Only for commands answered by a single line, and keep the batch within the board's serial buffer.
+        if (self.port == None) or (not self.has_begun):
+            self.in_error("Port or watchdog not initialized, cannot send cmd")
+            return
+
+        out_str = b''.join(byte_str + b'\n' for byte_str in byte_strs)
+        with trace.span('send_cmds', len(byte_strs)):
+            with serial_mutex:
+                with trace.span('serial io', out_str[:1]):
+                    self.port.write(out_str)
 
-            reply = self.port.read_until(b'\n')
-            if expect_ok and reply != b'ok\n':
-                print('Non-ok message received!!')
-            return reply
+                    replies = [self.port.read_until(b'\n') for _ in byte_strs]
+                return replies
 
     def stop(self):
         self.send_cmd(b'o')
 
     def read(self, do_print=True):
         reply = self.send_cmd(b'r', expect_ok=False)
-        vals = [int(val) for val in reply[:-1].decode().strip().split(',')]
+        with trace.span('parse read'):
+            vals = [int(val) for val in reply[:-1].decode().strip().split(',')]
         
         if do_print:
             print(f'ADC reading: {vals[0]}')
@@ -153,22 +188,34 @@ class Toaster:
     def profile_add_point(self, time_ms, temp_degc):
         cmd = b'pa'
         cmd += struct.pack('<if', time_ms, temp_degc)
-        self.send_cmd(cmd)
-        print(self.port.read_until(b'\n'))
+        if b'\n' in cmd:
+            # Would be split into two commands; toaster_profile.profile_points() avoids these
+            raise ValueError(f'Profile point ({time_ms} ms, {temp_degc} C) contains a newline byte')
+        info, _ = self.send_cmd(cmd, info_lines=1)
+        print(info[0])
 
     def profile_clear(self):
         cmd = b'pc'
         self.send_cmd(cmd)
 
+    def profile_query(self):
+        # (point count, time of the last point in ms), or None if the firmware doesn't support 'pq'
+        reply = self.send_cmd(b'pq', expect_ok=False)
+        try:
+            count, last_time_ms = [int(val) for val in reply[:-1].decode().strip().split(',')]
+        except (ValueError, AttributeError):
+            return None
+        return count, last_time_ms
+
     def profile_run(self):
         cmd = b'pr'
-        self.send_cmd(cmd)
-        print(self.port.read_until(b'\n'))
+        info, _ = self.send_cmd(cmd, info_lines=1)
+        print(info[0])
 
         
 if __name__ == "__main__":
 
-    with Toaster('COM3') as controller:
+    with Toaster() as controller:
         controller.begin_ctrl()
         while True:
             user_input = input('> ')
@@ -0,0 +1,219 @@
+import argparse
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local live dashboard: the control process only publishes samples into a TelemetryHub;
+# an HTTP server thread streams them to any number of browsers over server-sent events.
+# Each client gets at most MAX_RATE_HZ updates per second, every update carries all the
+# samples it missed, delta-encoded against the previous one.
+
+# Only this machine by default; '0.0.0.0' serves the dashboard to the whole network, unauthenticated
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 8000
+MAX_RATE_HZ = 4
+HISTORY_SAMPLES = 36000
+KEEPALIVE_S = 15
+
+# Sample fields, all integers so deltas stay exact: time (ms), temperature (mdegC),
+# desired temperature (mdegC), profile step, relay state (1 on, 0 off, -1 unknown)
+FIELDS = ['t', 'temp', 'desired', 'step', 'relay']
+
+
+class TelemetryHub:
+    def __init__(self, history=HISTORY_SAMPLES):
+        self.samples = deque(maxlen=history)
+        self.next_seq = 0
+        self.status = {'profile': '', 'n_steps': 0, 'state': 'idle'}
+        self.changed = threading.Condition()
+        self.start_time = time.time()
+
+    def publish(self, vals, relay=None, time_s=None):
+        # vals: a Toaster.read() reply
+        time_s = time.time() - self.start_time if time_s is None else time_s
+        sample = [int(time_s * 1000), int(vals[2]), int(vals[4]), int(vals[3]), -1 if relay is None else int(relay)]
+        with self.changed:
+            self.samples.append((self.next_seq, sample))
+            self.next_seq += 1
+            self.changed.notify_all()
+
+    def set_status(self, **status):
+        with self.changed:
+            self.status.update(status)
+            self.changed.notify_all()
+
+    def since(self, seq, timeout):
+        # Samples with a sequence number >= seq, waiting up to timeout for new ones
+        with self.changed:
+            if self.next_seq <= seq:
+                self.changed.wait(timeout)
+            first_seq = self.samples[0][0] if self.samples else self.next_seq
+            missed = first_seq > seq
+            # Walk back from the newest sample so the publisher's lock is held only for what's new
+            count = self.next_seq - max(seq, first_seq)
+            samples = [sample for _, sample in itertools.islice(reversed(self.samples), count)][::-1]
+            return samples, self.next_seq, dict(self.status), missed
+
+
+def encode_batch(samples, previous):
+    # First sample relative to the last one the client has (or absolute), the rest relative to each other
+    deltas = []
+    for sample in samples:
+        if previous is None:
+            deltas.append(sample)
+        else:
+            deltas.append([value - prev for value, prev in zip(sample, previous)])
+        previous = sample
+    return deltas, previous
+
+
+PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Toaster</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+#status span { margin-right: 2em; }
+canvas { border: 1px solid #ccc; width: 100%; height: 420px; }
+</style></head>
+<body>
+<div id="status"><span id="temp">-</span><span id="desired">-</span><span id="step">-</span><span id="relay">-</span><span id="profile">-</span></div>
+<canvas id="plot"></canvas>
+<script>
+const FIELDS = %FIELDS%;
+const data = FIELDS.map(() => []);
+let last = null;
+const canvas = document.getElementById('plot');
+
+function apply(msg) {
+  if (msg.reset) { data.forEach(column => column.length = 0); last = null; }
+  for (const delta of msg.samples) {
+    const sample = last === null ? delta : delta.map((value, i) => value + last[i]);
+    sample.forEach((value, i) => data[i].push(value));
+    last = sample;
+  }
+  const status = msg.status;
+  document.getElementById('profile').textContent = status.profile ? `${status.profile}: ${status.state}` : status.state;
+  if (last !== null) {
+    document.getElementById('temp').textContent = `Temperature ${(last[1] / 1000).toFixed(1)} C`;
+    document.getElementById('desired').textContent = `Desired ${(last[2] / 1000).toFixed(1)} C`;
+    document.getElementById('step').textContent = `Step ${last[3]}` + (status.n_steps ? ` / ${status.n_steps - 1}` : '');
+    document.getElementById('relay').textContent = last[4] < 0 ? 'Relay ?' : (last[4] ? 'Relay ON' : 'Relay off');
+  }
+  draw();
+}
+
+function draw() {
+  const ctx = canvas.getContext('2d');
+  canvas.width = canvas.clientWidth;
+  canvas.height = canvas.clientHeight;
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  const t = data[0];
+  if (t.length < 2) return;
+  const temps = data[1].concat(data[2]);
+  const tMin = t[0], tMax = t[t.length - 1];
+  const yMin = Math.min(...temps) - 5000, yMax = Math.max(...temps) + 5000;
+  const x = v => (v - tMin) / (tMax - tMin) * canvas.width;
+  const y = v => canvas.height - (v - yMin) / (yMax - yMin) * canvas.height;
+  for (const [column, colour] of [[2, 'blue'], [1, 'red']]) {
+    ctx.strokeStyle = colour;
+    ctx.beginPath();
+    t.forEach((time, i) => i ? ctx.lineTo(x(time), y(data[column][i])) : ctx.moveTo(x(time), y(data[column][i])));
+    ctx.stroke();
+  }
+}
+
+const events = new EventSource('/events');
+events.onmessage = event => apply(JSON.parse(event.data));
+window.onresize = draw;
+</script>
+</body></html>
+'''
+
+
+class DashboardHandler(BaseHTTPRequestHandler):
+    hub = None
+    max_rate_hz = MAX_RATE_HZ
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/':
+            body = PAGE.replace('%FIELDS%', json.dumps(FIELDS)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/events':
+            self.stream_events()
+        else:
+            self.send_error(404)
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        min_interval = 1.0 / self.max_rate_hz
+        seq = 0
+        previous = None
+        sent_status = None
+        try:
+            while True:
+                samples, seq_after, status, missed = self.hub.since(seq, KEEPALIVE_S)
+                reset = previous is None or missed
+                if reset:
+                    previous = None
+
+                if samples or reset or status != sent_status:
+                    deltas, previous = encode_batch(samples, previous)
+                    message = json.dumps({'samples': deltas, 'status': status, 'reset': reset}, separators=(',', ':'))
+                    self.wfile.write(f'data: {message}\n\n'.encode())
+                    sent_status = status
+                else:
+                    self.wfile.write(b': keepalive\n\n')
+                self.wfile.flush()
+                seq = seq_after
+
+                # Rate cap: anything published meanwhile goes out in the next batch
+                time.sleep(min_interval)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+def start_dashboard(hub=None, port=HTTP_PORT, max_rate_hz=MAX_RATE_HZ, host=HTTP_HOST):
+    hub = TelemetryHub() if hub is None else hub
+    handler = type('Handler', (DashboardHandler,), {'hub': hub, 'max_rate_hz': max_rate_hz})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Dashboard on http://{host}:{port}/')
+    return hub, server
+
+
+if __name__ == "__main__":
+    from toaster_ctrl import Toaster
+
+    parser = argparse.ArgumentParser(description='Serve live telemetry from a toaster to browsers')
+    parser.add_argument('--port', help='serial port of the toaster, found automatically by default')
+    parser.add_argument('--http-host', default=HTTP_HOST, help="address to serve on, '0.0.0.0' for every interface")
+    parser.add_argument('--http-port', type=int, default=HTTP_PORT)
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between read() polls')
+    parser.add_argument('--max-rate', type=float, default=MAX_RATE_HZ, help='updates per second per browser')
+    args = parser.parse_args()
+
+    hub, server = start_dashboard(port=args.http_port, max_rate_hz=args.max_rate, host=args.http_host)
+    with Toaster(args.port) as controller:
+        controller.begin_ctrl()
+        try:
+            while True:
+                vals = controller.read(do_print=False)
+                hub.publish(vals)
+                hub.set_status(state='running' if vals[3] >= 0 else 'idle')
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+from serial.tools import list_ports
+
+# Finds the boards on this machine. Every USB serial port is probed at the same time, each
+# with a short handshake: step_fct prints "Waiting..." at 115200 baud after a reset, the rev2
+# oven answers 'k' with "ok" at 38400 baud. Ports are opened exclusively, so a port another
+# program is using fails the probe instead of having its replies stolen.
+# Boards with a USB serial number are remembered in DEVICE_CACHE_FILE, including ones that
+# answered neither handshake, so a board is only probed (and reset) the first time it's seen.
+# find_device() returns a cached board of the kind asked for without touching any port.
+
+DEVICE_CACHE_FILE = 'device_cache.json'
+
+# Opening the port resets the Arduino; the bootloader runs for about 2 s before the sketch
+BOOT_TIME_S = 2.0
+BANNER_WAIT_S = 0.5      # step_fct prints its banner as soon as it boots
+PROBE_TIMEOUT_S = 1.0    # for a booted rev2 sketch to answer
+PROBE_INTERVAL_S = 0.1
+
+
+class SerialDevice:
+    KIND = None
+    BAUDRATE = None
+
+    def __init__(self, port, serial_number=None, description=''):
+        self.port = port
+        self.serial_number = serial_number
+        self.description = description
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.port!r}, serial_number={self.serial_number!r})'
+
+    @classmethod
+    def handshake(cls, ser, timeout_s):
+        # Called on a port opened at cls.BAUDRATE; True if the board answered like this kind
+        raise NotImplementedError
+
+    def open(self):
+        return serial.Serial(self.port, baudrate=self.BAUDRATE, timeout=1)
+
+
+class ToasterDevice(SerialDevice):
+    KIND = 'rev2'
+    BAUDRATE = 38400
+
+    @classmethod
+    def handshake(cls, ser, timeout_s):
+        # Keep-alives are harmless to a running oven
+        deadline = time.monotonic() + timeout_s
+        while time.monotonic() < deadline:
+            ser.write(b'k\n')
+            if ser.readline() == b'ok\n':
+                return True
+        return False
+
+    def open(self):
+        from toaster_ctrl import Toaster
+        return Toaster(self.port)
+
+
+class StepFctDevice(SerialDevice):
+    KIND = 'step_fct'
+    BAUDRATE = 115200
+    BANNER = b'Waiting...'
+
+    @classmethod
+    def handshake(cls, ser, timeout_s):
+        # Listens through the reset the port was just opened with; once the sketch has booted
+        # without printing the banner, this isn't step_fct
+        deadline = time.monotonic() + BOOT_TIME_S + BANNER_WAIT_S
+        while time.monotonic() < deadline:
+            if cls.BANNER in ser.readline():
+                return True
+        return False
+
+
+# Probe order matters: step_fct starts its run on the first newline it receives, so every port is
+# listened to for its banner before anything is written to it
+PROBE_ORDER = (StepFctDevice, ToasterDevice)
+DEVICE_TYPES = {device_type.KIND: device_type for device_type in PROBE_ORDER}
+REV2 = ToasterDevice.KIND
+STEP_FCT = StepFctDevice.KIND
+UNKNOWN = 'unknown'
+
+
+class DeviceCache:
+    def __init__(self, path=DEVICE_CACHE_FILE):
+        self.path = path
+        try:
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, serial_number):
+        return self.entries.get(serial_number)
+
+    def remember(self, serial_number, kind, port):
+        if serial_number is None:
+            return
+        entry = {'kind': kind, 'port': port}
+        if self.entries.get(serial_number) != entry:
+            self.entries[serial_number] = entry
+            self.save()
+
+    def forget(self, serial_number):
+        if self.entries.pop(serial_number, None) is not None:
+            self.save()
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.entries, file, indent=1)
+        os.replace(temp_path, self.path)
+
+
+def candidate_ports(include_all=False):
+    # USB serial adapters only, unless asked otherwise (built-in and bluetooth ports never answer)
+    return [info for info in list_ports.comports() if include_all or info.vid is not None]
+
+def probe_port(info, timeout_s=PROBE_TIMEOUT_S):
+    # Returns the device, UNKNOWN if the board answered neither handshake, or None if the port
+    # couldn't be opened (e.g. another program has it).
+    # The port is opened once, so the board is reset once: the listen-only handshakes run while
+    # it boots, then the baud rate is switched in place for the ones that talk to the booted sketch
+    try:
+        with serial.Serial(info.device, baudrate=PROBE_ORDER[0].BAUDRATE, timeout=PROBE_INTERVAL_S, exclusive=True) as ser:
+            for device_type in PROBE_ORDER:
+                if ser.baudrate != device_type.BAUDRATE:
+                    ser.baudrate = device_type.BAUDRATE
+                    ser.reset_input_buffer()
+                if device_type.handshake(ser, timeout_s):
+                    return device_type(info.device, info.serial_number, info.description)
+    except (serial.SerialException, OSError):
+        return None
+    return UNKNOWN
+
+def discover(kinds=None, cache=None, use_cache=True, include_all=False, timeout_s=PROBE_TIMEOUT_S, probe_if_cached=True):
+    # Returns the devices found, ordered by port. Boards in the cache aren't probed; with
+    # probe_if_cached=False nothing is probed at all when the cache already has a board of these kinds.
+    kinds = list(DEVICE_TYPES) if kinds is None else kinds
+    cache = DeviceCache() if cache is None else cache
+
+    devices = []
+    to_probe = []
+    for info in candidate_ports(include_all):
+        entry = cache.get(info.serial_number) if (use_cache and info.serial_number) else None
+        if entry is None:
+            to_probe.append(info)
+        elif entry['kind'] in kinds:
+            cache.remember(info.serial_number, entry['kind'], info.device)
+            devices.append(DEVICE_TYPES[entry['kind']](info.device, info.serial_number, info.description))
+
+    if to_probe and (probe_if_cached or not devices):
+        with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+            for info, device in zip(to_probe, executor.map(lambda info: probe_port(info, timeout_s), to_probe)):
+                if device is None:
+                    continue
+                if device == UNKNOWN:
+                    cache.remember(info.serial_number, UNKNOWN, info.device)
+                    continue
+                cache.remember(device.serial_number, device.KIND, device.port)
+                if device.KIND in kinds:
+                    devices.append(device)
+
+    return sorted(devices, key=lambda device: device.port)
+
+def find_device(kind, serial_number=None, cache=None):
+    # A cached board of this kind is returned straight away; ports are only probed when there's none
+    devices = [device for device in discover([kind], cache=cache, probe_if_cached=False)
+               if serial_number is None or device.serial_number == serial_number]
+    if not devices and serial_number is not None:
+        devices = [device for device in discover([kind], cache=cache)
+                   if device.serial_number == serial_number]
+    return devices[0] if devices else None
+
+def find_port(kind=REV2, fallback=None):
+    # Port of the first board of this kind, for scripts that used to hardcode one
+    device = find_device(kind)
+    if device is None:
+        print(f'No {kind} board found' + (f', trying {fallback}' if fallback else ''))
+        return fallback
+    print(f'Using {kind} board on {device.port}')
+    return device.port
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the toaster boards connected to this machine')
+    parser.add_argument('--kind', choices=list(DEVICE_TYPES), action='append', help='only look for this kind of board')
+    parser.add_argument('--rescan', action='store_true', help='probe every port, ignoring the cache (and boards cached as unknown)')
+    parser.add_argument('--all-ports', action='store_true', help='also probe ports that are not USB adapters')
+    parser.add_argument('--timeout', type=float, default=PROBE_TIMEOUT_S)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    devices = discover(args.kind, use_cache=not args.rescan, include_all=args.all_ports, timeout_s=args.timeout)
+    for device in devices:
+        print(f'{device.port:<16} {device.KIND:<10} {device.serial_number or "-":<24} {device.description}')
+    print(f'{len(devices)} device(s) in {time.monotonic() - start:.1f} s')
@@ -0,0 +1,227 @@
+import argparse
+import io
+import time
+
+import numpy as np
+
+# Per-profile process envelope: for every BIN_S seconds of a run, the mean, variance and a
+# histogram (quantile sketch) of every temperature archived for that profile. Each run
+# builds its own envelope as samples arrive (RunWriter does this), which is merged into the
+# profile's stored envelope when the run is finished, so past runs are never read again.
+# During a run, EnvelopeMonitor checks each reading against the historical mean +- k sigma
+# of its bin in constant time.
+
+BIN_S = 2.0
+HIST_MIN_DEGC = 0.0
+HIST_MAX_DEGC = 320.0
+HIST_STEP_DEGC = 0.5
+N_HIST = int((HIST_MAX_DEGC - HIST_MIN_DEGC) / HIST_STEP_DEGC)
+DEFAULT_K = 3.0
+MIN_RUNS = 3            # bins seen in fewer runs than this are not checked
+MIN_STD_DEGC = 0.5      # floor on sigma, so bins where every run read the same value don't flag noise
+
+ENVELOPE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS envelopes (
+    profile_hash TEXT PRIMARY KEY,
+    profile_name TEXT,
+    bin_s REAL NOT NULL,
+    n_runs INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    data BLOB NOT NULL
+);
+'''
+
+
+class Envelope:
+    def __init__(self, bin_s=BIN_S):
+        self.bin_s = bin_s
+        self.n_runs = 0
+        self.count = np.zeros(0, dtype=np.int64)
+        self.runs = np.zeros(0, dtype=np.int32)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.hist = np.zeros((0, N_HIST), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.count)
+
+    def resize(self, n_bins):
+        if n_bins <= len(self):
+            return
+        extra = n_bins - len(self)
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.runs = np.concatenate([self.runs, np.zeros(extra, dtype=np.int32)])
+        self.mean = np.concatenate([self.mean, np.zeros(extra)])
+        self.m2 = np.concatenate([self.m2, np.zeros(extra)])
+        self.hist = np.concatenate([self.hist, np.zeros((extra, N_HIST), dtype=np.int32)])
+
+    def add(self, time_s, temp_degc):
+        # Welford update of the sample's bin
+        if time_s < 0:
+            return
+        idx = int(time_s / self.bin_s)
+        if idx >= len(self):
+            self.resize(max(idx + 1, 2 * len(self)))
+        self.count[idx] += 1
+        delta = temp_degc - self.mean[idx]
+        self.mean[idx] += delta / self.count[idx]
+        self.m2[idx] += delta * (temp_degc - self.mean[idx])
+        hist_idx = min(max(int((temp_degc - HIST_MIN_DEGC) / HIST_STEP_DEGC), 0), N_HIST - 1)
+        self.hist[idx, hist_idx] += 1
+
+    def merge(self, run):
+        # Adds a run's envelope, with Chan's formula for combining means and variances
+        if run.bin_s != self.bin_s:
+            raise ValueError(f'Cannot merge envelopes with {run.bin_s} s and {self.bin_s} s bins')
+        n_bins = int(np.max(np.nonzero(run.count)[0], initial=-1)) + 1
+        self.resize(n_bins)
+
+        count_a, count_b = self.count[:n_bins], run.count[:n_bins]
+        total = count_a + count_b
+        safe_total = np.maximum(total, 1)
+        delta = run.mean[:n_bins] - self.mean[:n_bins]
+        self.mean[:n_bins] += delta * count_b / safe_total
+        self.m2[:n_bins] += run.m2[:n_bins] + delta * delta * count_a * count_b / safe_total
+        self.count[:n_bins] = total
+        self.runs[:n_bins] += count_b > 0
+        self.hist[:n_bins] += run.hist[:n_bins]
+        self.n_runs += 1
+
+    def std(self):
+        return np.sqrt(self.m2 / np.maximum(self.count - 1, 1))
+
+    def quantiles(self, qs):
+        # (len(qs), n_bins) temperatures from the histograms, to HIST_STEP_DEGC resolution
+        cumulative = np.cumsum(self.hist, axis=1)
+        result = np.full((len(qs), len(self)), np.nan)
+        for q_idx, q in enumerate(qs):
+            targets = q * cumulative[:, -1]
+            for idx in np.nonzero(self.count)[0]:
+                hist_idx = np.searchsorted(cumulative[idx], targets[idx])
+                result[q_idx, idx] = HIST_MIN_DEGC + (hist_idx + 0.5) * HIST_STEP_DEGC
+        return result
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, count=self.count, runs=self.runs, mean=self.mean, m2=self.m2, hist=self.hist)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data, bin_s, n_runs):
+        envelope = cls(bin_s)
+        envelope.n_runs = n_runs
+        with np.load(io.BytesIO(data)) as arrays:
+            envelope.count = arrays['count']
+            envelope.runs = arrays['runs']
+            envelope.mean = arrays['mean']
+            envelope.m2 = arrays['m2']
+            envelope.hist = arrays['hist']
+        return envelope
+
+
+def load_envelope(db, profile_hash):
+    row = db.execute('SELECT bin_s, n_runs, data FROM envelopes WHERE profile_hash = ?', (profile_hash,)).fetchone()
+    if row is None:
+        return None
+    return Envelope.from_bytes(row[2], row[0], row[1])
+
+def save_envelope(db, profile_hash, envelope, profile_name=None):
+    db.execute(
+        'INSERT INTO envelopes (profile_hash, profile_name, bin_s, n_runs, updated, data) VALUES (?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(profile_hash) DO UPDATE SET profile_name = COALESCE(excluded.profile_name, profile_name), '
+        'bin_s = excluded.bin_s, n_runs = excluded.n_runs, updated = excluded.updated, data = excluded.data',
+        (profile_hash, profile_name, envelope.bin_s, envelope.n_runs, time.time(), envelope.to_bytes()))
+
+def record_run(db, profile_hash, run_envelope, profile_name=None):
+    # Merges one run into its profile's envelope; call inside a transaction
+    if run_envelope.count.sum() == 0:
+        return
+    envelope = load_envelope(db, profile_hash) or Envelope(run_envelope.bin_s)
+    envelope.merge(run_envelope)
+    save_envelope(db, profile_hash, envelope, profile_name)
+
+
+class EnvelopeMonitor:
+    # Live conformance check. check() returns the deviation in sigmas of the first reading that
+    # leaves the band in each bin (so callers warn once per bin), None otherwise; every bin
+    # that left the band is kept in flagged, with its worst deviation.
+    def __init__(self, envelope, k=DEFAULT_K, min_runs=MIN_RUNS):
+        self.bin_s = envelope.bin_s
+        self.k = k
+        self.mean = envelope.mean.tolist()
+        self.std = np.maximum(envelope.std(), MIN_STD_DEGC).tolist()
+        self.checked = (envelope.runs >= min_runs).tolist()
+        self.flagged = {}
+
+    def check(self, time_s, temp_degc):
+        idx = int(time_s / self.bin_s)
+        if idx < 0 or idx >= len(self.checked) or not self.checked[idx]:
+            return None
+        deviation = (temp_degc - self.mean[idx]) / self.std[idx]
+        if abs(deviation) <= self.k:
+            return None
+        first = idx not in self.flagged
+        if first or abs(deviation) > abs(self.flagged[idx]):
+            self.flagged[idx] = deviation
+        return deviation if first else None
+
+    def band(self, time_s):
+        # (low, high) of the bin at time_s, or None if it isn't checked
+        idx = int(time_s / self.bin_s)
+        if idx < 0 or idx >= len(self.checked) or not self.checked[idx]:
+            return None
+        return self.mean[idx] - self.k * self.std[idx], self.mean[idx] + self.k * self.std[idx]
+
+
+def rebuild_envelopes(archive, bin_s=BIN_S):
+    # Recomputes every profile's envelope from the archived samples, for runs archived before envelopes existed
+    runs = [run for run in archive.find_runs() if run['profile_hash'] is not None and run['end_time'] is not None]
+    envelopes = {}
+    for run in runs:
+        run_envelope = Envelope(bin_s)
+        for sample in archive.load_samples(run['id']):
+            run_envelope.add(sample[0], sample[3] / 1000.0)
+        name, envelope = envelopes.setdefault(run['profile_hash'], (run['profile_name'], Envelope(bin_s)))
+        envelope.merge(run_envelope)
+
+    with archive.db:
+        archive.db.execute('DELETE FROM envelopes')
+        for profile_hash, (name, envelope) in envelopes.items():
+            save_envelope(archive.db, profile_hash, envelope, name)
+    return len(runs), len(envelopes)
+
+
+if __name__ == "__main__":
+    from toaster_archive import ARCHIVE_DIR, RunArchive
+
+    parser = argparse.ArgumentParser(description='Show or rebuild the per-profile temperature envelopes')
+    parser.add_argument('profile', nargs='?', help='profile name or hash; lists the envelopes if omitted')
+    parser.add_argument('--dir', default=ARCHIVE_DIR)
+    parser.add_argument('--rebuild', action='store_true', help='recompute every envelope from the archived runs')
+    parser.add_argument('-k', type=float, default=DEFAULT_K)
+    args = parser.parse_args()
+
+    with RunArchive(args.dir) as archive:
+        if args.rebuild:
+            n_runs, n_profiles = rebuild_envelopes(archive)
+            print(f'Rebuilt {n_profiles} envelope(s) from {n_runs} run(s)')
+
+        if args.profile is None:
+            for row in archive.db.execute('SELECT profile_hash, profile_name, n_runs, updated FROM envelopes ORDER BY profile_name'):
+                print(f"{row['profile_hash'][:12]}  {str(row['profile_name']):<16} runs={row['n_runs']}")
+            exit()
+
+        row = archive.db.execute('SELECT profile_hash FROM envelopes WHERE profile_name = ? OR profile_hash = ? '
+                                 'ORDER BY updated DESC', (args.profile, args.profile)).fetchone()
+        envelope = load_envelope(archive.db, row['profile_hash']) if row is not None else None
+        if envelope is None:
+            print(f'No envelope for {args.profile}')
+            exit(1)
+
+        std = envelope.std()
+        p05, p50, p95 = envelope.quantiles([0.05, 0.5, 0.95])
+        print(f'{"time (s)":>8} {"runs":>5} {"mean":>7} {"std":>6} {"low":>7} {"high":>7} {"p5":>7} {"p50":>7} {"p95":>7}')
+        for idx in np.nonzero(envelope.count)[0]:
+            print(f'{idx * envelope.bin_s:>8.0f} {envelope.runs[idx]:>5} {envelope.mean[idx]:>7.1f} {std[idx]:>6.2f} '
+                  f'{envelope.mean[idx] - args.k * std[idx]:>7.1f} {envelope.mean[idx] + args.k * std[idx]:>7.1f} '
+                  f'{p05[idx]:>7.1f} {p50[idx]:>7.1f} {p95[idx]:>7.1f}')
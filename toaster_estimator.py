@@ -0,0 +1,211 @@
+import argparse
+import os
+
+import numpy as np
+
+from toaster_model import ThermalModel
+
+# Kalman filter estimating oven temperature and rate of rise from single, noisy read() samples.
+#   state x = [T, R]   (degC, degC/s)
+#   T' = R
+#   R' = (heat_ramp * u - (T - ambient) / loss_tau - R) / rate_tau
+# with u the heater relay state. The process model is a reduced form of ThermalModel:
+# heat_ramp is the rate the oven starts rising at with the heater on, and rate_tau how
+# long the rate takes to respond to the relay.
+
+DEFAULT_RATE_NOISE = 0.1      # degC/s per sqrt(s) of unmodelled rate changes
+DEFAULT_TEMP_NOISE = 0.05     # degC per sqrt(s) of unmodelled temperature changes
+
+
+class EstimatorParams:
+    def __init__(self, ambient_degc, heat_ramp, loss_tau_s, rate_tau_s, measurement_std,
+                 temp_noise=DEFAULT_TEMP_NOISE, rate_noise=DEFAULT_RATE_NOISE):
+        self.ambient_degc = ambient_degc
+        self.heat_ramp = heat_ramp
+        self.loss_tau_s = loss_tau_s
+        self.rate_tau_s = rate_tau_s
+        self.measurement_std = measurement_std
+        self.temp_noise = temp_noise
+        self.rate_noise = rate_noise
+
+    @classmethod
+    def from_model(cls, model=None, **overrides):
+        model = ThermalModel() if model is None else model
+        params = {
+            'ambient_degc': model.ambient_degc,
+            'heat_ramp': model.heat_rate * model.element_tau_s / model.coupling_tau_s,
+            'loss_tau_s': model.loss_tau_s,
+            'rate_tau_s': model.element_tau_s + model.coupling_tau_s + model.sensor_tau_s,
+            'measurement_std': model.noise_degc,
+        }
+        params.update(overrides)
+        return cls(**params)
+
+
+def _predict(params, temp, rate, p00, p01, p11, u, dt):
+    # One prediction step, element-wise so it works on scalars and on arrays of runs
+    a = dt / params.rate_tau_s
+    f10 = -a / params.loss_tau_s
+    f11 = 1.0 - a
+
+    new_temp = temp + rate * dt
+    new_rate = rate + a * (params.heat_ramp * u - (temp - params.ambient_degc) / params.loss_tau_s - rate)
+
+    # P = F P F^T + Q, with F = [[1, dt], [f10, f11]]
+    n00 = p00 + 2 * dt * p01 + dt * dt * p11 + params.temp_noise ** 2 * dt
+    n01 = f10 * p00 + (f11 + f10 * dt) * p01 + f11 * dt * p11
+    n11 = f10 * f10 * p00 + 2 * f10 * f11 * p01 + f11 * f11 * p11 + params.rate_noise ** 2 * dt
+    return new_temp, new_rate, n00, n01, n11
+
+def _correct(params, temp, rate, p00, p01, p11, measured):
+    # Measurement of T only: H = [1, 0]
+    s = p00 + params.measurement_std ** 2
+    k0 = p00 / s
+    k1 = p01 / s
+    innovation = measured - temp
+    return (temp + k0 * innovation, rate + k1 * innovation,
+            (1 - k0) * p00, (1 - k0) * p01, p11 - k1 * p01)
+
+
+class TemperatureEstimator:
+    def __init__(self, params=None):
+        self.params = EstimatorParams.from_model() if params is None else params
+        self.temp = None
+        self.rate = 0.0
+        self.last_time = None
+        self.p00 = self.params.measurement_std ** 2
+        self.p01 = 0.0
+        self.p11 = 1.0
+
+    def reset(self, temp_degc=None, time_s=None):
+        self.temp = temp_degc
+        self.rate = 0.0
+        self.last_time = time_s
+        self.p00 = self.params.measurement_std ** 2
+        self.p01 = 0.0
+        self.p11 = 1.0
+
+    def update(self, temp_degc, relay_on, time_s):
+        # Feed one reading; returns the filtered (temperature, rate of rise)
+        if self.temp is None:
+            self.reset(temp_degc, time_s)
+            return self.temp, self.rate
+
+        dt = max(time_s - self.last_time, 0.0)
+        self.last_time = time_s
+        state = _predict(self.params, self.temp, self.rate, self.p00, self.p01, self.p11, float(relay_on), dt)
+        state = _correct(self.params, *state, temp_degc)
+        self.temp, self.rate, self.p00, self.p01, self.p11 = state
+        return self.temp, self.rate
+
+    @property
+    def temp_std(self):
+        return self.p00 ** 0.5
+
+
+def filter_batch(times, temps, relay, params=None):
+    # Offline re-filtering of many runs at once. times/temps/relay: (n_runs, n_samples) arrays
+    # (or 1D for a single run); shorter runs are padded with NaN temperatures, which are skipped.
+    params = EstimatorParams.from_model() if params is None else params
+    times = np.atleast_2d(np.asarray(times, dtype=np.float64))
+    temps = np.atleast_2d(np.asarray(temps, dtype=np.float64))
+    relay = np.broadcast_to(np.atleast_2d(np.asarray(relay, dtype=np.float64)), temps.shape)
+    n_runs, n_samples = temps.shape
+
+    temp_est = np.full(temps.shape, np.nan)
+    rate_est = np.full(temps.shape, np.nan)
+
+    temp = temps[:, 0].copy()
+    rate = np.zeros(n_runs)
+    p00 = np.full(n_runs, params.measurement_std ** 2)
+    p01 = np.zeros(n_runs)
+    p11 = np.ones(n_runs)
+    temp_est[:, 0] = temp
+    rate_est[:, 0] = rate
+
+    for k in range(1, n_samples):
+        valid = ~np.isnan(temps[:, k])
+        dt = np.where(valid, np.nan_to_num(times[:, k] - times[:, k - 1]), 0.0)
+        predicted = _predict(params, temp, rate, p00, p01, p11, relay[:, k - 1], dt)
+        corrected = _correct(params, *predicted, np.where(valid, temps[:, k], predicted[0]))
+        temp, rate, p00, p01, p11 = (np.where(valid, c, p) for c, p in zip(corrected, predicted))
+        temp_est[:, k] = np.where(valid, temp, np.nan)
+        rate_est[:, k] = np.where(valid, rate, np.nan)
+
+    return temp_est, rate_est
+
+def infer_relay(temps, desired, steps, hysteresis):
+    # read() doesn't report the relay, so replay the firmware's hysteresis law on the logged temperatures
+    temps = np.asarray(temps, dtype=np.float64)
+    relay = np.zeros(temps.shape)
+    state = np.zeros(temps.shape[:-1])
+    for k in range(temps.shape[-1]):
+        running = np.asarray(steps)[..., k] >= 0
+        state = np.where(temps[..., k] < desired[..., k] - hysteresis, 1.0,
+                         np.where(temps[..., k] > desired[..., k] + hysteresis, 0.0, state))
+        state = np.where(running, state, 0.0)
+        relay[..., k] = state
+    return relay
+
+class HysteresisRelay:
+    # Live counterpart of infer_relay(), one reading at a time
+    def __init__(self, hysteresis):
+        self.hysteresis = hysteresis
+        self.state = 0
+
+    def update(self, temp_degc, desired_degc, step):
+        if step < 0:
+            self.state = 0
+        elif temp_degc < desired_degc - self.hysteresis:
+            self.state = 1
+        elif temp_degc > desired_degc + self.hysteresis:
+            self.state = 0
+        return self.state
+
+def filter_archived_runs(archive, run_ids, params=None, default_hysteresis=3.0):
+    runs = []
+    for run_id in run_ids:
+        samples = np.asarray(archive.load_samples(run_id), dtype=np.float64).reshape(-1, 6)
+        run = archive.get_run(run_id)
+        hysteresis = run['hysteresis'] if run['hysteresis'] is not None else default_hysteresis
+        runs.append((run_id, samples, hysteresis))
+
+    n_samples = max((len(samples) for _, samples, _ in runs), default=0)
+    shape = (len(runs), n_samples)
+    times, temps, desired, steps = np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, -1.0)
+    hystereses = np.zeros((len(runs), 1))
+    for idx, (_, samples, hysteresis) in enumerate(runs):
+        n = len(samples)
+        times[idx, :n] = samples[:, 0]
+        temps[idx, :n] = samples[:, 3] / 1000.0
+        steps[idx, :n] = samples[:, 4]
+        desired[idx, :n] = samples[:, 5] / 1000.0
+        hystereses[idx] = hysteresis
+
+    relay = infer_relay(temps, desired, steps, hystereses[:, 0])
+    temp_est, rate_est = filter_batch(times, temps, relay, params)
+    return {run_id: (times[idx, :len(samples)], temp_est[idx, :len(samples)], rate_est[idx, :len(samples)])
+            for idx, (run_id, samples, _) in enumerate(runs)}
+
+
+if __name__ == "__main__":
+    from toaster_archive import RunArchive
+    from toaster_runfile import write_run
+
+    parser = argparse.ArgumentParser(description='Re-filter archived runs with the temperature estimator')
+    parser.add_argument('runs', nargs='*', type=int, help='run ids, defaults to every archived run')
+    parser.add_argument('--model', help='JSON file of ThermalModel parameters')
+    parser.add_argument('--output-dir', default=os.path.join('runs', 'filtered'))
+    args = parser.parse_args()
+
+    model = ThermalModel.from_file(args.model) if args.model else ThermalModel()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with RunArchive() as archive:
+        run_ids = args.runs or [run['id'] for run in archive.find_runs()]
+        results = filter_archived_runs(archive, run_ids, EstimatorParams.from_model(model))
+
+    for run_id, (times, temp_est, rate_est) in results.items():
+        path = os.path.join(args.output_dir, f'run_{run_id:06d}_filtered.trun')
+        write_run(path, {'time': times, 'temp': temp_est, 'rate': rate_est}, meta={'run_id': run_id})
+        print(f'Run {run_id} -> {path}')
@@ -0,0 +1,239 @@
+import bisect
+import csv
+import queue
+import threading
+import time
+
+import numpy as np
+
+from toaster_model import ThermalModel
+from toaster_profile import profile_duration, profile_setpoints
+import toaster_trace as trace
+
+# Host-side closed loop control of the heater relay, for running profiles from the PC.
+# An engine turns (temperature, upcoming setpoints) into a heater duty between 0 and 1, and
+# RelayPWM turns the duty into relay on/off with time-proportioning. HostController runs
+# read -> engine -> relay on a fixed period against absolute deadlines, with the whole
+# setpoint curve computed before the run; samples go out through queues, so CSV logging and
+# plotting happen on other threads and can't delay an actuation.
+
+CONTROL_PERIOD_S = 0.25
+PWM_PERIOD_S = 2.0
+MIN_PULSE_S = 0.25           # shortest on or off time the relay is switched for
+MPC_HORIZON_S = 40.0
+MPC_DT_S = 1.0
+MPC_DUTIES = np.linspace(0.0, 1.0, 11)
+MPC_OVERSHOOT_WEIGHT = 4.0   # cost of a degree above the setpoint, relative to one below
+LOG_COLUMNS = ['Time (s)', 'Temperature (C)', 'Goal (C)', 'Duty', 'Relay', 'Late (ms)']
+
+
+class PIDEngine:
+    # PID on the temperature error. The derivative is taken on the low-pass filtered measurement,
+    # so setpoint steps don't kick and single noisy readings don't flip the relay.
+    # Anti-windup by back-calculation: while the output is saturated, the integral is pulled
+    # back towards the value that would just reach the limit.
+    def __init__(self, kp=0.3, ki=0.003, kd=0.5, derivative_tau_s=3.0, tracking_tau_s=10.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.derivative_tau_s = derivative_tau_s
+        self.tracking_tau_s = tracking_tau_s
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.d_temp = 0.0
+        self.last_temp = None
+        self.last_time = None
+
+    def update(self, time_s, temp_degc, setpoints):
+        error = setpoints[0] - temp_degc
+        dt = 0.0 if self.last_time is None else time_s - self.last_time
+        if dt > 0:
+            alpha = dt / (self.derivative_tau_s + dt)
+            self.d_temp += alpha * ((temp_degc - self.last_temp) / dt - self.d_temp)
+        self.last_time = time_s
+        self.last_temp = temp_degc
+
+        unclamped = self.kp * error + self.integral - self.kd * self.d_temp
+        duty = min(max(unclamped, 0.0), 1.0)
+        self.integral += (self.ki * error + (duty - unclamped) / self.tracking_tau_s) * dt
+        return duty
+
+
+class MPCEngine:
+    # Short-horizon model predictive control on ThermalModel. The model is run alongside the oven
+    # and pulled towards each reading; every update then tries each pair of (duty for the next
+    # PWM period, duty for the rest of the horizon) in one vectorized simulation and keeps the
+    # first duty of the cheapest pair.
+    def __init__(self, model=None, period_s=CONTROL_PERIOD_S, horizon_s=MPC_HORIZON_S, dt=MPC_DT_S,
+                 duties=MPC_DUTIES, overshoot_weight=MPC_OVERSHOOT_WEIGHT, observer_gain=0.3):
+        self.model = ThermalModel() if model is None else model
+        self.period_s = period_s
+        self.n_steps = int(round(horizon_s / dt))
+        self.dt = dt
+        self.first_steps = max(int(round(PWM_PERIOD_S / dt)), 1)
+        first, rest = np.meshgrid(duties, duties, indexing='ij')
+        self.first_duty = first.ravel()
+        self.rest_duty = rest.ravel()
+        self.overshoot_weight = overshoot_weight
+        self.observer_gain = observer_gain
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.last_time = None
+        self.duty = 0.0
+
+    def observe(self, time_s, temp_degc):
+        if self.state is None:
+            self.state = self.model.initial_state(1, temp_degc)
+        else:
+            remaining = time_s - self.last_time
+            while remaining > 1e-9:
+                dt = min(remaining, self.dt)
+                self.model.step(self.state, self.duty, dt)
+                remaining -= dt
+            # Shift every state by the same correction, the readings only see the sensor
+            self.state += self.observer_gain * (temp_degc - self.state[2])
+        self.last_time = time_s
+
+    def update(self, time_s, temp_degc, setpoints):
+        self.observe(time_s, temp_degc)
+
+        # Setpoints every self.dt over the horizon, holding the last one past the end of the profile
+        sample_idx = np.minimum(np.round(np.arange(1, self.n_steps + 1) * self.dt / self.period_s).astype(np.int64),
+                                len(setpoints) - 1)
+        targets = np.asarray(setpoints)[sample_idx]
+
+        state = np.repeat(self.state, len(self.first_duty), axis=1)
+        cost = np.zeros(len(self.first_duty))
+        for k in range(self.n_steps):
+            u = self.first_duty if k < self.first_steps else self.rest_duty
+            self.model.step(state, u, self.dt)
+            error = state[1] - targets[k]
+            cost += np.where(error > 0, self.overshoot_weight, 1.0) * error * error
+
+        self.duty = float(self.first_duty[np.argmin(cost)])
+        return self.duty
+
+
+ENGINES = {'pid': PIDEngine, 'mpc': MPCEngine}
+
+
+class RelayPWM:
+    # Time-proportioned relay: on for the first duty * period of every period.
+    # Pulses shorter than min_pulse_s are dropped (or merged into a full period).
+    def __init__(self, period_s=PWM_PERIOD_S, min_pulse_s=MIN_PULSE_S):
+        self.period_s = period_s
+        self.min_pulse_s = min_pulse_s
+
+    def update(self, time_s, duty):
+        on_time = duty * self.period_s
+        if on_time < self.min_pulse_s:
+            return False
+        if on_time > self.period_s - self.min_pulse_s:
+            return True
+        return (time_s % self.period_s) < on_time
+
+
+class HostController:
+    def __init__(self, controller, engine, period_s=CONTROL_PERIOD_S, pwm=None, is_slow=False):
+        self.controller = controller
+        self.engine = engine
+        self.period_s = period_s
+        self.pwm = RelayPWM() if pwm is None else pwm
+        self.is_slow = is_slow
+        self.relay_on = None
+        self.missed_deadlines = 0
+        self.stop_event = threading.Event()
+
+    def set_relay(self, on):
+        if on == self.relay_on:
+            return
+        with trace.span('relay', on):
+            if on:
+                self.controller.on(self.is_slow)
+            else:
+                self.controller.off(self.is_slow)
+        self.relay_on = on
+
+    def run(self, steps, sinks=(), read_sinks=()):
+        # Runs the profile to its end (or until stop()); every control tick puts
+        # (time s, temperature C, goal C, duty, relay, lateness ms) on each sink queue, and
+        # (time s, Toaster.read() values) on each read sink, with the profile step and goal (mdegC)
+        # the host is running in place of the board's, as toaster_archive expects
+        n_ticks = int(np.ceil(profile_duration(steps) / self.period_s)) + 1
+        setpoints = profile_setpoints(steps, np.arange(n_ticks) * self.period_s)
+        step_times = [step[0] for step in steps]
+        self.engine.reset()
+        self.missed_deadlines = 0
+
+        start = time.monotonic()
+        tick = 0
+        try:
+            self.set_relay(False)
+            while tick < n_ticks and not self.stop_event.is_set():
+                deadline = start + tick * self.period_s
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+                with trace.span('control tick', tick):
+                    time_s = time.monotonic() - start
+                    vals = self.controller.read(do_print=False)
+                    temp_degc = vals[2] / 1000.0
+                    duty = self.engine.update(time_s, temp_degc, setpoints[tick:])
+                    self.set_relay(self.pwm.update(time_s, duty))
+                late_ms = (time.monotonic() - deadline) * 1000.0
+
+                sample = (time_s, temp_degc, float(setpoints[tick]), duty, int(self.relay_on), late_ms)
+                for sink in sinks:
+                    try:
+                        sink.put_nowait(sample)
+                    except queue.Full:
+                        pass
+                if read_sinks:
+                    profile_step = min(bisect.bisect_right(step_times, time_s), len(steps) - 1)
+                    read_sample = (time_s, list(vals[:3]) + [profile_step, int(round(setpoints[tick] * 1000.0))])
+                    for sink in read_sinks:
+                        try:
+                            sink.put_nowait(read_sample)
+                        except queue.Full:
+                            pass
+
+                # When a tick overruns, skip the deadlines already missed rather than bunching up
+                next_tick = int((time.monotonic() - start) / self.period_s) + 1
+                self.missed_deadlines += max(next_tick - tick - 1, 0)
+                tick = max(next_tick, tick + 1)
+        finally:
+            self.set_relay(False)
+            for sink in (*sinks, *read_sinks):
+                try:
+                    sink.put_nowait(None)
+                except queue.Full:
+                    pass
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def start_csv_logger(path, columns=LOG_COLUMNS):
+    # Writes every sample put on the returned queue to path, until None is put
+    samples = queue.Queue()
+
+    def write_samples():
+        with open(path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(columns)
+            while True:
+                sample = samples.get()
+                if sample is None:
+                    return
+                writer.writerow(sample)
+                if samples.empty():
+                    csvfile.flush()
+
+    thread = threading.Thread(target=write_samples, daemon=True)
+    thread.start()
+    return samples, thread
@@ -1,6 +1,8 @@
 from toaster_ctrl import Toaster
+from toaster_profile import read_profile, upload_profile
 from tkinter import filedialog
 import matplotlib.pyplot as plt
+import asyncio
 import time
 import enum
 
@@ -11,6 +13,7 @@ DEFAULT_TEMP_DEGC = 20
 DEFAULT_GAIN = -150.0
 DEFAULT_HYSTERESIS_DEGC = 3
 SAMPLING_INTERVAL = 1
+PLOT_WINDOW = 60
 
 class Command_ID(enum.Enum):
     OFF = {'o', 'off'}
@@ -24,139 +27,309 @@ class Command_ID(enum.Enum):
     RUN_PROFILE = {'run', 'run_profile'}
     SHOW_PLOT = {'show'}
     HIDE_PLOT = {'hide'}
+    JOBS = {'j', 'jobs'}
+    WAIT = {'w', 'wait'}
+    CANCEL = {'cancel'}
 
-all_data = [[]] * 5
-show_plot = False
-fig, ax = plt.subplots()
 
-def sample(host: Toaster):
-    while True:
-        data = host.read(do_print=False)
-        for idx, val in enumerate(data):
-            all_data[idx].append(val)
-
-        if show_plot:
-            ax.clear()
-            min_index = max(len(all_data[0]) - 60, 0)
-            temps = all_data[2][min_index:-1]
-            desired_temps = all_data[4][min_index:-1]
-            range = list(range(len(temps)))
-            ax.plot(range, temps, color = 'r')
-            ax.plot(range, desired_temps, color='b')
-            plt.draw()
-
-        time.sleep(SAMPLING_INTERVAL)
-    
-current_profile = []
-profile_name = ''
-
-def load_profile(args):
-    filename = ''
-    if len(args) < 2:
-        # Get filename from dialog
-        filename = filedialog.askopenfilename(initialdir = ".",
-                                        title = "Select a File",
-                                        filetypes = (("CSV files", "*.csv*"),
-                                                    ("Text files", "*.txt*"),
-                                                    ("all files", "*.*")))
-    else:
-        filename = args[1]
-
-    stripped_name = filename.split("/")[-1].split("\\")[-1].split(".")[0]
-
-    steps = []
-    try:
-        with open(filename, 'r') as file:
-            lines = file.readlines()
-            steps = [[int(i) for i in line.strip().split(',')] for line in lines]
-    except:
-        print("Error reading file")
-        return [], ''
-
-    if len(steps) < 1:
-        print("Empty file or failed to read")
-        return [], ''
-
-    for step in steps:
-        if len(step) != 2:
-            print("Error in parsing file")
-            return [], ''
-    return steps, stripped_name
-
-
-with Toaster(comport='COM3') as host:
-    host.begin_ctrl()
-    host.set_gain(DEFAULT_GAIN)
-    host.on(is_slow=True)
-
-    sampling_thread = Thread(target=sample, args=host, daemon=True)
-    sampling_thread.start()
+class Job:
+    def __init__(self, job_id, profile_name, n_steps):
+        self.job_id = job_id
+        self.profile_name = profile_name
+        self.n_steps = n_steps
+        self.state = 'starting'
+        self.start_time = time.time()
+        self.end_time = None
+        self.task = None
 
+    def describe(self, step):
+        elapsed = (self.end_time or time.time()) - self.start_time
+        progress = f', step {step}/{self.n_steps - 1}' if self.state == 'running' else ''
+        return f'[{self.job_id}] {self.profile_name}: {self.state}, {elapsed:.0f} s{progress}'
 
-    while True:
 
-        user_input = input('> ')
+class Host:
+    # All serial calls run in worker threads (Toaster already serializes them with serial_mutex),
+    # so the event loop keeps reading commands and telemetry while a profile runs.
+    def __init__(self, toaster):
+        self.toaster = toaster
+        self.all_data = [[] for _ in range(5)]
+        self.new_sample = asyncio.Condition()
+        self.jobs = {}
+        self.next_job_id = 1
+        self.current_profile = []
+        self.profile_name = ''
+        self.show_plot = False
+        self.fig = None
+        self.ax = None
+
+    async def call(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    def latest(self, idx):
+        return self.all_data[idx][-1] if len(self.all_data[idx]) > 0 else None
+
+    def running_job(self):
+        for job in self.jobs.values():
+            if job.state in ('starting', 'running'):
+                return job
+        return None
+
+    async def sample(self):
+        while True:
+            try:
+                data = await self.call(self.toaster.read, False)
+            except (ValueError, IndexError):
+                print('\nBad telemetry reply')
+                await asyncio.sleep(SAMPLING_INTERVAL)
+                continue
+            for idx, val in enumerate(data):
+                self.all_data[idx].append(val)
+
+            async with self.new_sample:
+                self.new_sample.notify_all()
+
+            if self.show_plot:
+                self.draw_plot()
+
+            await asyncio.sleep(SAMPLING_INTERVAL)
+
+    def draw_plot(self):
+        min_index = max(len(self.all_data[0]) - PLOT_WINDOW, 0)
+        temps = [val / 1000.0 for val in self.all_data[2][min_index:]]
+        desired_temps = [val / 1000.0 for val in self.all_data[4][min_index:]]
+        x = list(range(len(temps)))
+        self.ax.clear()
+        self.ax.plot(x, temps, color='r')
+        self.ax.plot(x, desired_temps, color='b')
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
+    async def run_profile(self, job):
+        try:
+            await self.call(self.toaster.profile_run)
+            job.state = 'running'
+            warned = False
+            seen_running = False
 
-        args = user_input.split(' ')
+            while True:
+                async with self.new_sample:
+                    await self.new_sample.wait()
+                step = self.latest(3)
+
+                if step >= 0:
+                    seen_running = True
+                if step == job.n_steps - 1 and not warned:
+                    print(f'\nJob {job.job_id}: last profile step, OPEN THE DOOR!\a')
+                    warned = True
+                if seen_running and step < 0:
+                    break
+
+            job.state = 'done' if warned else 'interrupted'
+        except asyncio.CancelledError:
+            job.state = 'cancelled'
+            await asyncio.shield(self.call(self.toaster.stop))
+            raise
+        except Exception as e:
+            job.state = f'failed ({e})'
+        finally:
+            job.end_time = time.time()
+            print(f'\n{job.describe(self.latest(3))}')
+
+    def load_profile(self, args):
+        if len(args) < 2:
+            # Get filename from dialog
+            filename = filedialog.askopenfilename(initialdir = ".",
+                                            title = "Select a File",
+                                            filetypes = (("CSV files", "*.csv*"),
+                                                        ("Text files", "*.txt*"),
+                                                        ("all files", "*.*")))
+        else:
+            filename = args[1]
+        return read_profile(filename)
+
+    def find_job(self, args):
+        if len(args) > 1:
+            try:
+                return self.jobs.get(int(args[1]))
+            except ValueError:
+                return None
+        return self.running_job() or (self.jobs[max(self.jobs)] if self.jobs else None)
+
+    async def handle(self, args):
+        # Returns a job when the operator asked to wait for it
         command_id = args[0]
 
-        if command_id in Command_ID.OFF:
-            host.off()
-    
-        elif command_id in Command_ID.HYSTERESIS.union(Command_ID.CALIBRATE, Command_ID.GAIN):
+        if command_id in Command_ID.OFF.value:
+            # Takes effect as soon as the serial line is free; the firmware also drops any running profile
+            await self.call(self.toaster.off)
+
+        elif command_id in Command_ID.HYSTERESIS.value.union(Command_ID.CALIBRATE.value, Command_ID.GAIN.value):
             if len(args) < 2:
                 print('Not enough values for command')
-                continue
+                return
             floatval = float(args[1])
 
-            if command_id in Command_ID.GAIN:
-                host.set_gain(floatval)
-            elif command_id in Command_ID.HYSTERESIS:
-                host.set_hysteresis(floatval)
-            elif command_id in Command_ID.CALIBRATE:
-                host.set_calibration(floatval)
-
-        elif command_id in Command_ID.REPORT:
-            host.read()
+            if command_id in Command_ID.GAIN.value:
+                await self.call(self.toaster.set_gain, floatval)
+            elif command_id in Command_ID.HYSTERESIS.value:
+                await self.call(self.toaster.set_hysteresis, floatval)
+            elif command_id in Command_ID.CALIBRATE.value:
+                await self.call(self.toaster.set_calibration, floatval)
 
-        elif command_id in Command_ID.EXIT:
-            break
+        elif command_id in Command_ID.REPORT.value:
+            await self.call(self.toaster.read)
 
-        elif command_id in Command_ID.DEFAULT:
-            host.set_gain(DEFAULT_GAIN)
-            host.set_hysteresis(DEFAULT_HYSTERESIS_DEGC)
-            host.set_calibration(DEFAULT_TEMP_DEGC)
+        elif command_id in Command_ID.DEFAULT.value:
+            await self.call(self.toaster.set_gain, DEFAULT_GAIN)
+            await self.call(self.toaster.set_hysteresis, DEFAULT_HYSTERESIS_DEGC)
+            await self.call(self.toaster.set_calibration, DEFAULT_TEMP_DEGC)
 
-        elif command_id in Command_ID.LOAD_PROFILE:
-            loaded_profile, name = load_profile(args)
+        elif command_id in Command_ID.LOAD_PROFILE.value:
+            if self.running_job() is not None:
+                print('Cannot load a profile while one is running')
+                return
+            loaded_profile, name = self.load_profile(args)
             if loaded_profile == []:
-                continue
-            current_profile = loaded_profile
-            profile_name = name
-
-            host.profile_clear()
-            for step in loaded_profile:
-                host.profile_add_point(step[0] * 1000, step[1])
-    
-        elif command_id in Command_ID.RUN_PROFILE:
-            start_index = len(all_data)
-            host.profile_run()
-            print('Running profile...')
-            while True:
-                if all_data[-1][3] == len(current_profile) - 1:
-                    break
-                time.sleep(SAMPLING_INTERVAL)
-            print('Profile done!')
-        
-        elif command_id in Command_ID.SHOW_PLOT:
-            plt.show()
+                return
+            self.current_profile = loaded_profile
+            self.profile_name = name
+
+            if not await self.call(upload_profile, self.toaster, loaded_profile):
+                print('Profile already loaded on the oven')
+
+        elif command_id in Command_ID.RUN_PROFILE.value:
+            if self.current_profile == []:
+                print('No profile loaded')
+                return
+            if self.running_job() is not None:
+                print(f'Job {self.running_job().job_id} is already running')
+                return
+
+            job = Job(self.next_job_id, self.profile_name, len(self.current_profile))
+            self.next_job_id += 1
+            self.jobs[job.job_id] = job
+            job.task = asyncio.create_task(self.run_profile(job))
+            print(f'Started job {job.job_id}')
+
+        elif command_id in Command_ID.JOBS.value:
+            if not self.jobs:
+                print('No jobs')
+            for job in self.jobs.values():
+                print(job.describe(self.latest(3)))
 
-        elif command_id in Command_ID.HIDE_PLOT:
-            plt.close()
+        elif command_id in Command_ID.WAIT.value:
+            # The caller holds back further commands until the returned job ends
+            job = self.find_job(args)
+            if job is None:
+                print('No such job')
+                return None
+            if job.task.done():
+                print(job.describe(self.latest(3)))
+                return None
+            print(f'Waiting for job {job.job_id}...')
+            return job
+
+        elif command_id in Command_ID.CANCEL.value:
+            job = self.find_job(args)
+            if job is None or job.task.done():
+                print('No such running job')
+                return
+            job.task.cancel()
+            await asyncio.wait({job.task})
+
+        elif command_id in Command_ID.SHOW_PLOT.value:
+            if self.fig is None:
+                plt.ion()
+                self.fig, self.ax = plt.subplots()
+            plt.show(block=False)
+            self.show_plot = True
+
+        elif command_id in Command_ID.HIDE_PLOT.value:
+            self.show_plot = False
+            if self.fig is not None:
+                plt.close(self.fig)
+                self.fig, self.ax = None, None
 
         else:
             print('Input not recognized')
-            continue
-    
-    host.off()
-    host.off(is_slow=True)
\ No newline at end of file
+
+
+def read_input(loop, queue):
+    # input() blocks, so it runs on its own daemon thread and feeds the event loop
+    while True:
+        try:
+            line = input('> ')
+        except EOFError:
+            line = 'exit'
+        loop.call_soon_threadsafe(queue.put_nowait, line)
+        if line.split(' ')[0] in Command_ID.EXIT.value:
+            return
+
+async def main():
+    with Toaster() as toaster:
+        toaster.begin_ctrl()
+        host = Host(toaster)
+        sampling_task = None
+        try:
+            await host.call(toaster.set_gain, DEFAULT_GAIN)
+            await host.call(toaster.on, True)
+
+            sampling_task = asyncio.create_task(host.sample())
+
+            lines = asyncio.Queue()
+            Thread(target=read_input, args=(asyncio.get_running_loop(), lines), daemon=True).start()
+
+            # While waiting for a job, typed commands are held back and run once it ends;
+            # only off and cancel get through straight away
+            waiting_for = None
+            held = []
+            next_line = None
+            while True:
+                if waiting_for is None and held:
+                    line = held.pop(0)
+                else:
+                    if next_line is None:
+                        next_line = asyncio.create_task(lines.get())
+                    pending = {next_line} if waiting_for is None else {next_line, waiting_for.task}
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                    if waiting_for is not None and waiting_for.task in done:
+                        print(f'Done waiting for job {waiting_for.job_id}' + (f', running {len(held)} held command(s)' if held else ''))
+                        waiting_for = None
+                    if next_line not in done:
+                        continue
+                    line = next_line.result()
+                    next_line = None
+
+                args = line.strip().split(' ')
+                if args[0] == '':
+                    continue
+                if waiting_for is not None and not (args[0] in Command_ID.OFF.value or args[0] in Command_ID.CANCEL.value):
+                    held.append(line)
+                    print(f'Waiting for job {waiting_for.job_id}, "{line.strip()}" will run when it ends (off and cancel run now)')
+                    continue
+                if args[0] in Command_ID.EXIT.value:
+                    break
+                try:
+                    job = await host.handle(args)
+                    if job is not None and not job.task.done():
+                        waiting_for = job
+                except ValueError:
+                    print('Input not recognized')
+
+        finally:
+            # However the loop ends (exit, Ctrl-C, a serial error), the relays are turned off:
+            # the firmware has no watchdog to do it
+            for job in host.jobs.values():
+                if not job.task.done():
+                    job.task.cancel()
+            if sampling_task is not None:
+                sampling_task.cancel()
+
+            await host.call(toaster.off)
+            await host.call(toaster.off, True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+
+# Lumped thermal model of the oven, used by the tuning sweep, the estimator and the host controller.
+#   heating element E: dE/dt = heat_rate * u - (E - T) / element_tau
+#   oven air/board  T: dT/dt = (E - T) / coupling_tau - (T - ambient) / loss_tau
+#   sensor          S: dS/dt = (T - S) / sensor_tau
+# u is the heater relay state (0 or 1). All states are in degC and every operation is
+# vectorized, so one call steps any number of independent simulations.
+
+DEFAULT_PARAMS = {
+    'ambient_degc': 20.0,
+    'heat_rate': 3.0,         # degC/s the element heats at when on
+    'element_tau_s': 8.0,
+    'coupling_tau_s': 12.0,
+    'loss_tau_s': 150.0,
+    'sensor_tau_s': 4.0,
+    'sensor_gain': -150.0,    # true degC/V of the thermistor amplifier
+    'noise_degc': 0.5,        # std of a single ADC-derived temperature reading
+}
+
+
+class ThermalModel:
+    def __init__(self, **params):
+        unknown = set(params) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError(f'Unknown model parameters: {", ".join(sorted(unknown))}')
+        self.params = {**DEFAULT_PARAMS, **params}
+        for name, value in self.params.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as file:
+            return cls(**json.load(file))
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.params, file, indent=1)
+
+    def initial_state(self, n, temp_degc=None):
+        temp_degc = self.ambient_degc if temp_degc is None else temp_degc
+        return np.full((3, n), float(temp_degc))
+
+    def derivatives(self, state, u):
+        element, oven, sensor = state
+        d_element = self.heat_rate * u - (element - oven) / self.element_tau_s
+        d_oven = (element - oven) / self.coupling_tau_s - (oven - self.ambient_degc) / self.loss_tau_s
+        d_sensor = (oven - sensor) / self.sensor_tau_s
+        return np.array([d_element, d_oven, d_sensor])
+
+    def step(self, state, u, dt):
+        # Explicit Euler, dt should stay well below the smallest time constant
+        state += self.derivatives(state, u) * dt
+        return state
+
+    def measure(self, state, gain, calibration_degc=None, rng=None):
+        # Temperature the firmware computes from the sensor with its configured gain,
+        # calibrated at ambient: errors in gain scale the measured rise above ambient
+        calibration_degc = self.ambient_degc if calibration_degc is None else calibration_degc
+        measured = calibration_degc + (state[2] - calibration_degc) * (gain / self.sensor_gain)
+        if rng is not None and self.noise_degc > 0:
+            measured = measured + rng.normal(0.0, self.noise_degc, size=measured.shape)
+        return measured
@@ -28,6 +28,9 @@
  *      e.g. b'pc' -> clears all points in the current profile.
  *    'pr' (profile run)
  *      begins controlling the toaster according to the previously set points.
+ *    'pq' (profile query)
+ *      e.g. b'pq' -> replies "[point count],[time_ms of the last point]\n" instead of "ok".
+ *      Allowed while a profile is running.
  * changed 'r' (report) command to return temperature in milli-degrees C.
 */
 
@@ -194,6 +197,12 @@ void loop() {
           else digitalWrite(FAST_RELAY_EN, state == 1 ? LOW : HIGH);
           break;
         case 'p':  // Profile control, read second character
+          if (io_buf[1] == 'q') {  // Query the loaded profile, lets the host skip re-uploading it
+            sprintf(io_buf, "%d,%lu\n", the_profile.max_index,
+                    the_profile.max_index > 0 ? the_profile.points[the_profile.max_index-1].time_after_start_ms : 0UL);
+            io_buf_repopulated = true;
+            break;
+          }
           if (the_profile.running) break;  // Disallow modifying the profile while it is running
           switch (io_buf[1]) {
             case 'a':  // Add a point to the profile
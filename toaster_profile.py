@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+# Temperature the firmware interpolates from before the first profile point
+PROFILE_START_TEMP_DEGC = 20.0
+
+# Which profile each port was last loaded with, so unchanged profiles aren't uploaded again
+PROFILE_CACHE_FILE = 'profile_cache.json'
+
+
+def profile_name(filename):
+    return filename.split("/")[-1].split("\\")[-1].split(".")[0]
+
+def read_profile(filename):
+    steps = []
+    try:
+        with open(filename, 'r') as file:
+            lines = [line for line in file.readlines() if line.strip() != '']
+            steps = [[int(i) for i in line.strip().split(',')] for line in lines]
+    except (OSError, ValueError):
+        print("Error reading file")
+        return [], ''
+
+    if len(steps) < 1:
+        print("Empty file or failed to read")
+        return [], ''
+
+    for step in steps:
+        if len(step) != 2:
+            print("Error in parsing file")
+            return [], ''
+
+    return steps, profile_name(filename)
+
+def frameable_point(time_ms, temp_degc):
+    # The firmware splits commands on '\n', so a packed point must not contain that byte:
+    # move the time to the next millisecond, and the temperature to the nearest float32 without one
+    while b'\n' in struct.pack('<i', time_ms):
+        time_ms += 1
+    bits = struct.unpack('<i', struct.pack('<f', temp_degc))[0]
+    for offset in range(1 << 24):
+        for candidate in (bits + offset, bits - offset):
+            packed = struct.pack('<i', candidate)
+            if b'\n' not in packed:
+                return time_ms, float(np.frombuffer(packed, dtype='<f4')[0])
+    raise ValueError(f'No sendable temperature near {temp_degc}')
+
+def profile_points(steps):
+    # Points exactly as they are sent with 'pa': (time in ms, temperature in degC)
+    return [frameable_point(int(step[0] * 1000), float(step[1])) for step in steps]
+
+def profile_hash(steps):
+    # Hash of the packed points, so two files describing the same profile hash the same
+    digest = hashlib.sha1()
+    for time_ms, temp_degc in profile_points(steps):
+        digest.update(struct.pack('<if', time_ms, temp_degc))
+    return digest.hexdigest()
+
+def profile_duration(steps):
+    return float(steps[-1][0])
+
+def profile_setpoints(steps, times_s, start_temp_degc=PROFILE_START_TEMP_DEGC):
+    # Desired temperature at each time, interpolated between points the same way the firmware does
+    point_times = [0.0] + [float(step[0]) for step in steps]
+    point_temps = [start_temp_degc] + [float(step[1]) for step in steps]
+    return np.interp(times_s, point_times, point_temps)
+
+def profile_fingerprint(steps):
+    return f'{len(steps)}:{profile_hash(steps)}'
+
+
+class ProfileCache:
+    def __init__(self, path=PROFILE_CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, port):
+        return self.entries.get(port)
+
+    def remember(self, port, steps):
+        points = profile_points(steps)
+        self.entries[port] = {'fingerprint': profile_fingerprint(steps), 'count': len(points), 'last_time_ms': points[-1][0]}
+        self.save()
+
+    def forget(self, port):
+        if self.entries.pop(port, None) is not None:
+            self.save()
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.entries, file, indent=1)
+        os.replace(temp_path, self.path)
+
+    def is_loaded(self, controller, steps):
+        # Cheap check: our last upload to this port was this profile, and the firmware still holds a
+        # profile of the same size ending at the same time (a reset board reports 0 points)
+        entry = self.get(controller.comport)
+        if entry is None or entry['fingerprint'] != profile_fingerprint(steps):
+            return False
+        loaded = controller.profile_query()
+        return loaded is not None and loaded == (entry['count'], entry['last_time_ms'])
+
+
+def upload_profile(controller, steps, cache=None, force=False):
+    # Returns True if the profile had to be uploaded, False if the oven already held it
+    cache = ProfileCache() if cache is None else cache
+    if not force and cache.is_loaded(controller, steps):
+        return False
+
+    cache.forget(controller.comport)
+    controller.profile_clear()
+    for time_ms, temp_degc in profile_points(steps):
+        controller.profile_add_point(time_ms, temp_degc)
+    cache.remember(controller.comport, steps)
+    return True
@@ -1,16 +1,33 @@
 import time
 from datetime import datetime
 from toaster_ctrl import Toaster
+from toaster_archive import RunArchive
+from toaster_envelope import EnvelopeMonitor, load_envelope
+from toaster_dashboard import start_dashboard
+from toaster_estimator import HysteresisRelay
+from toaster_profile import profile_hash, upload_profile
+import toaster_trace as trace
 from tkinter import filedialog
 import matplotlib.pyplot as plt
 
 from threading import Thread
 
 HYSTERESIS = 3
+GAIN = -162.6
+COMPORT = None  # None: use the rev2 board toaster_discovery finds
 
-fig = plt.figure()
-temp_ax = fig.add_subplot(1, 2, 1)
-step_ax = fig.add_subplot(1, 2, 2)
+# The live view is served by toaster_dashboard on DASHBOARD_PORT, so nothing is drawn in the
+# control loop. Set SHOW_PLOT to also get the matplotlib window on this machine.
+SHOW_PLOT = False
+DASHBOARD_HOST = '127.0.0.1'  # '0.0.0.0' to watch from another machine
+DASHBOARD_PORT = 8000
+
+ENVELOPE_K = 3
+
+if SHOW_PLOT:
+    fig = plt.figure()
+    temp_ax = fig.add_subplot(1, 2, 1)
+    step_ax = fig.add_subplot(1, 2, 2)
 
 def sound_alarm():
     while True:
@@ -20,41 +37,55 @@ def sound_alarm():
 def controller_init(controller):
     controller.begin_ctrl()
     time.sleep(0.1)
-    controller.set_gain(-162.6)
+    controller.set_gain(GAIN)
     time.sleep(0.1)
-    controller.set_calibration(float(input("Temp ? ")))
-    time.sleep(0.1)
-    controller.profile_clear()
+    calibration_temp = float(input("Temp ? "))
+    controller.set_calibration(calibration_temp)
     time.sleep(0.1)
     controller.set_hysteresis(HYSTERESIS)
     time.sleep(0.1)
+    return calibration_temp
 
-def do_1_iteration(controller, data):
+def do_1_iteration(controller, data, run_writer=None, hub=None, relay=None, monitor=None):
     vals = controller.read()#do_print=False)
     time_ms = time.time() - start_time
+    if run_writer is not None:
+        with trace.span('archive write'):
+            run_writer.add(time_ms, vals)
     temperature_degc = vals[2] / 1000.0
     profile_step = vals[3]
     desired_temperature_degc = vals[4] / 1000.0
 
-    # if abs(temperature_degc - desired_temperature_degc) > HYSTERESIS:
-    #     print('WARNING! TEMPERATURE OUTSIDE DESIRED RANGE\a')
+    if hub is not None:
+        relay_state = relay.update(temperature_degc, desired_temperature_degc, profile_step) if relay is not None else None
+        hub.publish(vals, relay=relay_state, time_s=time_ms)
+
+    if monitor is not None:
+        deviation = monitor.check(time_ms, temperature_degc)
+        if deviation is not None:
+            print(f'WARNING! {temperature_degc:.1f} C at {time_ms:.0f} s is {deviation:+.1f} sigma from past runs of this profile\a')
     
     data[0].append(time_ms)
     data[1].append(temperature_degc)
     data[2].append(desired_temperature_degc)
     data[3].append(profile_step)
 
-    temp_ax.clear()
-    temp_ax.plot(data[0], data[1], color='r')
-    temp_ax.plot(data[0], data[2], color='b')
-    temp_ax.plot(data[0], [item + HYSTERESIS for item in data[2]], color='0.8', linestyle='dashed', linewidth=1)
-    temp_ax.plot(data[0], [item - HYSTERESIS for item in data[2]], color='0.8', linestyle='dashed', linewidth=1)
+    if not SHOW_PLOT:
+        return profile_step
 
-    step_ax.clear()
-    step_ax.plot(data[0], data[3], color='tab:orange')
+    with trace.span('plot refresh'):
+        temp_ax.clear()
+        temp_ax.plot(data[0], data[1], color='r')
+        temp_ax.plot(data[0], data[2], color='b')
+        temp_ax.plot(data[0], [item + HYSTERESIS for item in data[2]], color='0.8', linestyle='dashed', linewidth=1)
+        temp_ax.plot(data[0], [item - HYSTERESIS for item in data[2]], color='0.8', linestyle='dashed', linewidth=1)
 
-    fig.canvas.draw()
-    fig.canvas.flush_events()
+        step_ax.clear()
+        step_ax.plot(data[0], data[3], color='tab:orange')
+
+        fig.canvas.draw()
+        with trace.span('flush_events'):
+            fig.canvas.flush_events()
 
     return profile_step
 
@@ -85,55 +116,73 @@ if __name__ == "__main__":
             print("Error in parsing file")
             exit()
 
-    output_csv_filename = f'runs/run_{stripped_name}_{datetime.now().strftime("%y-%m-%d__%H-%M")}.csv'
+    output_csv_filename = f'runs/run_{stripped_name}_{datetime.now().strftime("%y-%m-%d__%H-%M-%S")}.csv'
 
     data = [[] for _ in range(4)]
 
-    plt.ion()
-    plt.show()
+    if SHOW_PLOT:
+        plt.ion()
+        plt.show()
+
+    hub, _ = start_dashboard(port=DASHBOARD_PORT, host=DASHBOARD_HOST)
+    hub.set_status(profile=stripped_name, n_steps=len(steps), state='loading')
+    relay = HysteresisRelay(HYSTERESIS)
 
     alarm_thread = Thread(target=sound_alarm, daemon=True)
 
     # Setup the Toaster
-    controller = Toaster('COM6')
-    with controller:
-        controller_init(controller)
+    controller = Toaster(COMPORT)
+    with controller, RunArchive() as archive:
+        calibration_temp = controller_init(controller)
 
         print("initialized")
 
-        for step in steps:
-            controller.profile_add_point(step[0] * 1000, step[1])
+        if upload_profile(controller, steps):
+            print("profile set")
+        else:
+            print("profile already loaded")
 
-        print("profile set")
+        # Flag readings outside ENVELOPE_K sigma of past runs of this profile
+        envelope = load_envelope(archive.db, profile_hash(steps))
+        monitor = EnvelopeMonitor(envelope, k=ENVELOPE_K) if envelope is not None else None
+        if monitor is not None:
+            print(f'Checking against {envelope.n_runs} past run(s)')
 
         start_time = time.time()
-        controller.profile_run()
-        time.sleep(0.1)
+        with archive.begin_run(steps, stripped_name, port=controller.comport, gain=GAIN, hysteresis=HYSTERESIS,
+                               calibration_temp=calibration_temp, start_time=start_time) as run_writer:
+            controller.profile_run()
+            hub.set_status(state='running')
+            time.sleep(0.1)
 
-        while True:
-            profile_step = do_1_iteration(controller, data)
-            time.sleep(1)
+            while True:
+                profile_step = do_1_iteration(controller, data, run_writer, hub, relay, monitor)
+                time.sleep(1)
 
-            if profile_step == len(steps) - 1:
-                print('WARNING: OPEN THE DOOR!!\a')
+                if profile_step == len(steps) - 1:
+                    print('WARNING: OPEN THE DOOR!!\a')
 
-            if profile_step < 0:
-                break
+                if profile_step < 0:
+                    break
 
-        alarm_thread.start()
+            alarm_thread.start()
+            hub.set_status(state='done, OPEN THE DOOR')
         
-        # Take some readings after profile officially finishes
-        for i in range(30):
-            do_1_iteration(controller, data)
+            # Take some readings after profile officially finishes
+            for i in range(30):
+                do_1_iteration(controller, data, run_writer, hub, relay, monitor)
+
+                time.sleep(1)
 
-            time.sleep(1)
+        print(f'Run archived as #{run_writer.run_id}')
 
 
-    with open(output_csv_filename, 'w+') as csvfile:
+    with trace.span('csv write'), open(output_csv_filename, 'w+') as csvfile:
         csvfile.write('Time (s), Temperature (C), Desired (C), Profile step,\n')
         for index, time_ms in enumerate(data[0]):
             line = f'{time_ms}, {data[1][index]}, {data[2][index]}, {data[3][index]}\n'
             csvfile.write(line)
 
-    plt.ioff()
-    plt.show()
+    if SHOW_PLOT:
+        plt.ioff()
+        plt.show()
@@ -1,17 +1,29 @@
+import queue
+import threading
 import time
 from datetime import datetime
 from toaster_ctrl import Toaster
+from toaster_profile import read_profile
+from toaster_archive import start_run_archiver
+from toaster_host_control import ENGINES, HostController, start_csv_logger
 from tkinter import filedialog
 import pylab as plt
+import toaster_trace as trace
 
-WINDOW = 3
+# 'pid' or 'mpc', see toaster_host_control
+ENGINE = 'pid'
+PLOT_INTERVAL_S = 0.5
+PLOT_QUEUE_SIZE = 10000
+
+GAIN = -150.0
+CALIBRATION_TEMP = 20.0
 
 def controller_init(controller):
     controller.begin_ctrl()
     time.sleep(0.1)
-    controller.set_gain(-150.0)
+    controller.set_gain(GAIN)
     time.sleep(0.1)
-    controller.set_calibration(20.0)
+    controller.set_calibration(CALIBRATION_TEMP)
     time.sleep(0.1)
     controller.on(True)
     time.sleep(0.1)
@@ -23,26 +35,10 @@ if __name__ == "__main__":
                                           filetypes = (("CSV files", "*.csv*"),
                                                        ("Text files", "*.txt*"),
                                                        ("all files", "*.*")))
-    stripped_name = filename.split("/")[-1].split("\\")[-1].split(".")[0]
-
-    steps = []
-    try:
-        with open(filename, 'r') as file:
-            lines = file.readlines()
-            steps = [[int(i) for i in line.strip().split(',')] for line in lines]
-    except:
-        print("Error reading file")
-        steps = []
-
-    if len(steps) < 1:
-        print("Empty file or failed to read")
+    steps, stripped_name = read_profile(filename)
+    if steps == []:
         exit()
 
-    for step in steps:
-        if len(step) != 2:
-            print("Error in parsing file")
-            exit()
-
     X = []
     Y1 = []
     Y2 = []
@@ -53,57 +49,50 @@ if __name__ == "__main__":
     graph, = ax.plot(X, Y1, "bo")
     graph_goal, = ax.plot(X, Y2, "r+")
 
-    with open(f'runs/run_{stripped_name}_{datetime.now().strftime("%y-%m-%d__%H-%M")}.csv', 'w+') as csvfile:
-        csvfile.write('Time (s), Temperature (C), Status, Goal (C)\n')
-
-        # Setup the Toaster
-        with Toaster('COM3') as controller:
-            controller_init(controller)
-
-            last_temp = 20
-            last_timestep = 0
-            start_time = time.time()
-            is_on = False
-            curr_step = 0
-
-            for step in steps:
-                next_temp = step[1]
-                next_timestep = step[0]
-
-                equation = float(next_temp - last_temp) / float(next_timestep - last_timestep)
-
-                delta = time.time() - start_time
-                while (delta < next_timestep):
-                    curr_temp = controller.read()[2]
-                    goal_temp = equation * (delta-last_timestep) + last_temp
-
-                    if (curr_temp > goal_temp + WINDOW):
-                        # too high
-                        controller.off()
-                        is_on = False
-
-                    if (curr_temp < goal_temp - WINDOW):
-                        # too low
-                        controller.on()
-                        is_on = True
-
-                    csvfile.write(f"{delta}, {curr_temp}, {is_on}, {goal_temp}\n")
-
-                    X.append(delta)
-                    Y1.append(curr_temp)
-                    Y2.append(goal_temp)
+    # Control runs on its own thread; the logger and this plot loop only consume its samples
+    log_queue, log_thread = start_csv_logger(f'runs/run_{stripped_name}_{datetime.now().strftime("%y-%m-%d__%H-%M-%S")}.csv')
+    plot_queue = queue.Queue(maxsize=PLOT_QUEUE_SIZE)
+
+    # Setup the Toaster
+    with Toaster() as controller:
+        controller_init(controller)
+
+        archive_queue, archive_thread = start_run_archiver(steps, stripped_name, port=controller.comport, gain=GAIN,
+                                                          calibration_temp=CALIBRATION_TEMP)
+
+        host_controller = HostController(controller, ENGINES[ENGINE]())
+        control_thread = threading.Thread(target=host_controller.run, args=(steps, (log_queue, plot_queue), (archive_queue,)))
+        control_thread.start()
+
+        try:
+            while control_thread.is_alive():
+                while True:
+                    try:
+                        sample = plot_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if sample is None:
+                        break
+                    X.append(sample[0])
+                    Y1.append(sample[1])
+                    Y2.append(sample[2])
+
+                with trace.span('plot refresh'):
                     graph.set_data(X, Y1)
                     graph_goal.set_data(X, Y2)
                     ax.relim()
                     ax.autoscale_view(True,True,True)
-                    figure.canvas.draw()
-                    figure.canvas.flush_events()
-
-                    time.sleep(0.25)
-                    delta = time.time() - start_time
-
-                print(f"Done with step {curr_step}")
-                curr_step += 1
+                    figure.canvas.draw_idle()
+                    with trace.span('flush_events'):
+                        figure.canvas.flush_events()
+                time.sleep(PLOT_INTERVAL_S)
+        except KeyboardInterrupt:
+            host_controller.stop()
+
+        control_thread.join()
+        log_thread.join()
+        archive_thread.join()
+        print(f"Done, {host_controller.missed_deadlines} missed control deadline(s)")
 
     plt.ioff()
-    plt.show()
\ No newline at end of file
+    plt.show()
@@ -0,0 +1,260 @@
+import argparse
+import contextlib
+import json
+import struct
+import sys
+import time
+
+from toaster_profile import read_profile, upload_profile
+
+# Batch recipes for the host command set, one command per line ('#' starts a comment):
+#   g <gain>                  set amplifier gain
+#   h <degC>                  set hysteresis
+#   c <degC>                  calibrate to the current temperature
+#   m slow|fast 0|1           manual relay control
+#   o | off                   turn the oven off
+#   r | report                read the current values
+#   load <profile file>       upload a profile (skipped if the oven already holds it)
+#   run                       start the loaded profile
+#   wait <seconds>            sleep
+#   wait_temp <|> <degC> [timeout s]     wait until the temperature crosses a threshold
+#   wait_profile [timeout s]  wait for the running profile to finish
+# The whole recipe is validated before anything is sent. Consecutive simple commands are
+# pipelined to the board in one write, and every command emits one JSON result line.
+
+# The rev2 board reads commands from a 64 byte serial buffer
+PIPELINE_BYTES = 60
+POLL_INTERVAL_S = 0.5
+DEFAULT_WAIT_TIMEOUT_S = 3600
+
+FLOAT_COMMANDS = {'g': b'g', 'h': b'h', 'c': b'c'}
+ALIASES = {'off': 'o', 'report': 'r'}
+
+
+class RecipeStep:
+    def __init__(self, line_no, source, name, args):
+        self.line_no = line_no
+        self.source = source
+        self.name = name
+        self.args = args
+        self.payload = None   # encoded command for pipelined steps
+        self.steps = None     # profile points for 'load'
+
+
+def check_payload(payload, what):
+    if b'\n' in payload:
+        # The firmware frames commands on '\n', so this command would be cut short
+        raise ValueError(f'{what} cannot be sent, its encoding contains a newline byte')
+    return payload
+
+def encode_float(prefix, value):
+    return check_payload(prefix + struct.pack('<f', value), value)
+
+def parse_number(text, what):
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError(f'{what} must be a number, got {text!r}')
+
+def parse_step(line_no, source):
+    args = source.split()
+    name = ALIASES.get(args[0], args[0])
+    step = RecipeStep(line_no, source, name, args[1:])
+
+    if name in FLOAT_COMMANDS:
+        if len(args) != 2:
+            raise ValueError(f'{name} takes exactly one value')
+        step.payload = encode_float(FLOAT_COMMANDS[name], parse_number(args[1], 'Value'))
+    elif name == 'm':
+        if len(args) != 3 or args[1] not in ('slow', 'fast') or args[2] not in ('0', '1'):
+            raise ValueError('usage: m slow|fast 0|1')
+        relay = b'\x01' if args[1] == 'slow' else b'\x02'
+        state = b'\x02' if args[2] == '1' else b'\x01'
+        step.payload = b'm' + relay + state
+    elif name == 'o':
+        step.payload = b'o'
+    elif name == 'r':
+        pass
+    elif name == 'load':
+        if len(args) != 2:
+            raise ValueError('usage: load <profile file>')
+        step.steps, _ = read_profile(args[1])
+        if step.steps == []:
+            raise ValueError(f'Could not read profile {args[1]}')
+    elif name == 'run':
+        pass
+    elif name == 'wait':
+        if len(args) != 2 or parse_number(args[1], 'Wait time') < 0:
+            raise ValueError('usage: wait <seconds>')
+    elif name == 'wait_temp':
+        if len(args) not in (3, 4) or args[1] not in ('<', '>'):
+            raise ValueError('usage: wait_temp <|> <degC> [timeout s]')
+        parse_number(args[2], 'Temperature')
+        if len(args) == 4:
+            parse_number(args[3], 'Timeout')
+    elif name == 'wait_profile':
+        if len(args) > 2:
+            raise ValueError('usage: wait_profile [timeout s]')
+        if len(args) == 2:
+            parse_number(args[1], 'Timeout')
+    else:
+        raise ValueError(f'Unknown command {args[0]!r}')
+    return step
+
+def parse_recipe(lines):
+    # Returns (steps, errors); a recipe with errors must not be run
+    steps = []
+    errors = []
+    for line_no, line in enumerate(lines, start=1):
+        source = line.split('#', 1)[0].strip()
+        if source == '':
+            continue
+        try:
+            steps.append(parse_step(line_no, source))
+        except ValueError as e:
+            errors.append(f'line {line_no}: {e}')
+
+    if any(step.name == 'run' for step in steps) and not any(step.name == 'load' for step in steps):
+        errors.append('recipe runs a profile but never loads one')
+    return steps, errors
+
+def pipeline_batches(steps):
+    # Groups consecutive simple commands into batches that fit the board's buffer
+    batch = []
+    batch_bytes = 0
+    for step in steps:
+        if step.payload is not None and batch_bytes + len(step.payload) + 1 <= PIPELINE_BYTES:
+            batch.append(step)
+            batch_bytes += len(step.payload) + 1
+            continue
+        if batch:
+            yield batch
+        if step.payload is not None:
+            batch, batch_bytes = [step], len(step.payload) + 1
+        else:
+            batch, batch_bytes = [], 0
+            yield [step]
+    if batch:
+        yield batch
+
+def read_temp(controller):
+    vals = controller.read(do_print=False)
+    return vals, vals[2] / 1000.0
+
+def wait_until(controller, condition, timeout_s):
+    deadline = time.monotonic() + timeout_s
+    while True:
+        vals, temp = read_temp(controller)
+        if condition(vals, temp):
+            return True, vals
+        if time.monotonic() >= deadline:
+            return False, vals
+        time.sleep(POLL_INTERVAL_S)
+
+def run_step(controller, step):
+    # Returns (ok, details) for a step that isn't pipelined
+    if step.name == 'r':
+        vals = controller.read(do_print=False)
+        return True, {'values': vals}
+
+    if step.name == 'load':
+        uploaded = upload_profile(controller, step.steps)
+        return True, {'uploaded': uploaded, 'points': len(step.steps)}
+
+    if step.name == 'run':
+        controller.profile_run()
+        return True, {}
+
+    if step.name == 'wait':
+        time.sleep(float(step.args[0]))
+        return True, {}
+
+    if step.name == 'wait_temp':
+        threshold = float(step.args[1])
+        timeout_s = float(step.args[2]) if len(step.args) > 2 else DEFAULT_WAIT_TIMEOUT_S
+        if step.args[0] == '>':
+            ok, vals = wait_until(controller, lambda vals, temp: temp > threshold, timeout_s)
+        else:
+            ok, vals = wait_until(controller, lambda vals, temp: temp < threshold, timeout_s)
+        return ok, {'temp': vals[2] / 1000.0}
+
+    if step.name == 'wait_profile':
+        timeout_s = float(step.args[0]) if step.args else DEFAULT_WAIT_TIMEOUT_S
+        ok, vals = wait_until(controller, lambda vals, temp: vals[3] < 0, timeout_s)
+        return ok, {'step': vals[3]}
+
+    raise ValueError(f'Unhandled step {step.name}')
+
+def run_recipe(controller, steps, emit):
+    # Stops at the first failing step and turns the oven off; returns True if every step succeeded.
+    # Anything else that ends the run early (Ctrl-C, a serial error) also turns the oven off first,
+    # the firmware's watchdog is disabled so a relay left on would stay on.
+    try:
+        for batch in pipeline_batches(steps):
+            start = time.monotonic()
+            try:
+                if batch[0].payload is not None:
+                    replies = controller.send_cmds([step.payload for step in batch])
+                    elapsed_ms = (time.monotonic() - start) * 1000.0
+                    results = [(step, reply == b'ok\n', {'reply': reply.decode(errors='replace').strip()}) for step, reply in zip(batch, replies)]
+                else:
+                    ok, details = run_step(controller, batch[0])
+                    elapsed_ms = (time.monotonic() - start) * 1000.0
+                    results = [(batch[0], ok, details)]
+            except (ValueError, IndexError) as e:
+                elapsed_ms = (time.monotonic() - start) * 1000.0
+                results = [(batch[0], False, {'error': str(e)})]
+
+            for step, ok, details in results:
+                emit({'line': step.line_no, 'command': step.source, 'ok': ok, 'elapsed_ms': round(elapsed_ms, 1), **details})
+
+            if not all(ok for _, ok, _ in results):
+                controller.stop()
+                emit({'aborted': True, 'line': results[-1][0].line_no})
+                return False
+        return True
+    except BaseException:
+        controller.stop()
+        raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a recipe of toaster commands')
+    parser.add_argument('recipe', help="recipe file, or '-' for stdin")
+    parser.add_argument('--port', help='serial port of the toaster, found automatically by default')
+    parser.add_argument('--check', action='store_true', help='only validate the recipe')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    if args.recipe == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.recipe, 'r') as file:
+            lines = file.readlines()
+
+    steps, errors = parse_recipe(lines)
+    for error in errors:
+        print(f'ERROR: {error}', file=sys.stderr)
+    if errors:
+        exit(1)
+    if args.check:
+        print(f'Recipe OK, {len(steps)} step(s)')
+        exit()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+
+    def emit(result):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    # Results go to output; whatever the serial helpers print (raw replies, port discovery) to stderr
+    from toaster_ctrl import Toaster
+    with contextlib.redirect_stdout(sys.stderr), Toaster(args.port) as controller:
+        controller.begin_ctrl()
+        start = time.monotonic()
+        ok = run_recipe(controller, steps, emit)
+        emit({'done': ok, 'elapsed_ms': round((time.monotonic() - start) * 1000.0, 1)})
+
+    if output is not sys.stdout:
+        output.close()
+    exit(0 if ok else 1)
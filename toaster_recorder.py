@@ -20,7 +20,7 @@ time.sleep(0.1)
 
 now = datetime.now()
 try:
-    with open(f'output/run_{now.strftime("%y-%m-%d__%H-%M")}.csv', 'w+') as csvfile:
+    with open(f'output/run_{now.strftime("%y-%m-%d__%H-%M-%S")}.csv', 'w+') as csvfile:
         csvfile.write('ADC Value, ADC Voltage, Calculated temperature\n')
         counter = 0
         while True:
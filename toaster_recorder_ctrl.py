@@ -1,10 +1,22 @@
 import time
 from datetime import datetime
 from toaster_ctrl import Toaster
+from toaster_calibration import latest_calibration
+from toaster_estimator import TemperatureEstimator
+import numpy as np
 
 SAMPLING_RATE_HZ = 10
 
-with Toaster('COM6') as controller:
+# With the estimator, each logged value comes from a single read() instead of an average of
+# SAMPLING_RATE_HZ reads, and the filtered rate of rise is logged as well
+USE_ESTIMATOR = True
+POLLS_PER_VALUE = 1 if USE_ESTIMATOR else SAMPLING_RATE_HZ
+
+calibration = latest_calibration()
+if calibration is not None:
+    print(f'Using calibration {calibration.name}')
+
+with Toaster() as controller:
     controller.begin_ctrl()
     time.sleep(0.1)
     controller.set_gain(-150.0)
@@ -18,19 +30,33 @@ with Toaster('COM6') as controller:
 
     now = datetime.now()
     try:
-        with open(f'output/run_{now.strftime("%y-%m-%d__%H-%M")}.csv', 'w+') as csvfile:
-            csvfile.write('ADC Value, ADC Voltage, Calculated temperature\n')
+        with open(f'output/run_{now.strftime("%y-%m-%d__%H-%M-%S")}.csv', 'w+') as csvfile:
+            if USE_ESTIMATOR:
+                csvfile.write('ADC Value, ADC Voltage, Calculated temperature, Rate (C/s)\n')
+            else:
+                csvfile.write('ADC Value, ADC Voltage, Calculated temperature\n')
+            estimator = TemperatureEstimator()
             counter = 0
             while True:
-                total_vals = [0, 0, 0]
+                reads = []
+
+                for i in range(POLLS_PER_VALUE):
+                    reads.append(controller.read(do_print=False))
+                    time.sleep(1.0 / POLLS_PER_VALUE)
 
-                for i in range(SAMPLING_RATE_HZ):
-                    vals = controller.read(do_print=False)
-                    total_vals = [a + b for a, b in zip(total_vals, vals)]
-                    time.sleep(1.0 / SAMPLING_RATE_HZ)
+                block = np.array(reads)
+                total_vals = block[:, :3].mean(axis=0)
+                if calibration is not None:
+                    temps = calibration.apply_reads(block)
+                else:
+                    temps = block[:, 2] / 1000.0
 
-                total_vals[2] /= 100.0
-                total_vals = [val / SAMPLING_RATE_HZ for val in total_vals]
+                if USE_ESTIMATOR:
+                    # Both relays are held on for the whole recording
+                    temp, rate = estimator.update(temps[-1], 1.0, time.monotonic())
+                    total_vals = [total_vals[0], total_vals[1], temp, rate]
+                else:
+                    total_vals[2] = temps.mean()
                 csvfile.write(', '.join([str(i) for i in total_vals]))
                 csvfile.write('\n')
                 counter += 1
@@ -0,0 +1,229 @@
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+# Columnar run file (.trun)
+#   header:  b'TRUN' + version (uint16) + reserved (uint16)
+#   columns: one contiguous fixed-width block per column, each aligned to 8 bytes
+#   footer:  JSON index (column name -> dtype, offset, count) + metadata
+#   trailer: footer length (uint32) + b'TRUN'
+# Timestamps are stored as ms deltas from 'time_base_ms' in the footer.
+
+MAGIC = b'TRUN'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')
+TRAILER = struct.Struct('<I4s')
+ALIGNMENT = 8
+
+COLUMN_DTYPES = {
+    'time': '<u2',      # ms since previous sample, widened to '<u4' if a gap doesn't fit
+    'adc': '<i2',       # ADC reading
+    'voltage': '<i2',   # ADC voltage (mV)
+    'temp': '<f4',      # temperature (degC)
+    'desired': '<f4',   # desired temperature (degC)
+    'step': '<i2',      # profile step, -1 when no profile is running
+    'relay': '<i1',     # relay state, when the host controlled it
+    'duty': '<f4',      # heater duty from toaster_host_control, 0 to 1
+}
+
+# Header names used by the CSV writers in this repo
+CSV_COLUMNS = {
+    'time (s)': 'time',
+    'temperature (c)': 'temp',
+    'calculated temperature': 'temp',
+    'desired (c)': 'desired',
+    'goal (c)': 'desired',
+    'profile step': 'step',
+    'status': 'relay',
+    'relay': 'relay',
+    'duty': 'duty',
+    'adc value': 'adc',
+    'adc voltage': 'voltage',
+    'rate (c/s)': 'rate',
+}
+
+# The recorders log one averaged row per second and don't write a time column
+RECORDER_PERIOD_S = 1.0
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _column_array(name, values):
+    dtype = np.dtype(COLUMN_DTYPES.get(name, '<f4'))
+    values = np.asarray(values)
+    if dtype.kind in 'iu' and values.dtype.kind == 'f' and not np.all(np.mod(values, 1) == 0):
+        # Averaged values (e.g. from the recorders) would lose precision as integers
+        dtype = np.dtype('<f4')
+    return values.astype(dtype)
+
+def write_run(path, columns, meta=None):
+    n_samples = None
+    for name, values in columns.items():
+        if n_samples is None:
+            n_samples = len(values)
+        elif len(values) != n_samples:
+            raise ValueError(f'Column {name} has {len(values)} samples, expected {n_samples}')
+
+    footer = {'version': VERSION, 'n_samples': n_samples or 0, 'meta': meta or {}, 'columns': {}}
+    blocks = []
+
+    for name, values in columns.items():
+        if name == 'time':
+            time_ms = np.round(np.asarray(values, dtype=np.float64) * 1000.0).astype(np.int64)
+            base_ms = int(time_ms[0]) if len(time_ms) > 0 else 0
+            deltas = np.diff(time_ms, prepend=base_ms)
+            if np.any(deltas < 0):
+                raise ValueError('Timestamps must be increasing')
+            dtype = '<u2' if len(deltas) == 0 or deltas.max() <= 0xFFFF else '<u4'
+            array = deltas.astype(dtype)
+            footer['time_base_ms'] = base_ms
+        else:
+            array = _column_array(name, values)
+        blocks.append((name, array))
+
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, 0))
+        for name, array in blocks:
+            offset = _align(file.tell())
+            file.write(b'\0' * (offset - file.tell()))
+            file.write(array.tobytes())
+            footer['columns'][name] = {'dtype': array.dtype.str, 'offset': offset, 'count': len(array)}
+
+        footer_bytes = json.dumps(footer).encode()
+        file.write(footer_bytes)
+        file.write(TRAILER.pack(len(footer_bytes), MAGIC))
+
+
+class RunFile:
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+
+        magic, version, _ = HEADER.unpack(self.buffer[:HEADER.size].tobytes())
+        footer_len, end_magic = TRAILER.unpack(self.buffer[-TRAILER.size:].tobytes())
+        if magic != MAGIC or end_magic != MAGIC:
+            raise ValueError(f'{path} is not a run file')
+        if version > VERSION:
+            raise ValueError(f'{path} has unsupported version {version}')
+
+        footer_start = len(self.buffer) - TRAILER.size - footer_len
+        self.footer = json.loads(self.buffer[footer_start:footer_start + footer_len].tobytes())
+        self.meta = self.footer['meta']
+        self._time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.footer['n_samples']
+
+    def __contains__(self, name):
+        return name in self.footer['columns']
+
+    def __getitem__(self, name):
+        if name == 'time':
+            return self.time
+        return self.raw(name)
+
+    @property
+    def columns(self):
+        return list(self.footer['columns'])
+
+    def raw(self, name):
+        # Zero-copy view straight into the mapped file
+        column = self.footer['columns'][name]
+        dtype = np.dtype(column['dtype'])
+        start = column['offset']
+        return self.buffer[start:start + column['count'] * dtype.itemsize].view(dtype)
+
+    @property
+    def time(self):
+        # The only column that needs decoding; computed once and cached
+        if self._time is None:
+            deltas = self.raw('time')
+            self._time = (np.cumsum(deltas, dtype=np.int64) + self.footer['time_base_ms']) / 1000.0
+        return self._time
+
+    def close(self):
+        # Only drops our reference: views handed out by raw() keep the mapping alive until
+        # they are garbage collected, unmapping it under them would crash on the next access
+        self._time = None
+        self.buffer = None
+
+def _parse_csv_value(text):
+    text = text.strip()
+    if text == 'True':
+        return 1.0
+    if text == 'False':
+        return 0.0
+    return float(text)
+
+def read_csv_run(csv_path):
+    with open(csv_path, 'r') as file:
+        header = file.readline()
+        names = [CSV_COLUMNS.get(field.strip().lower()) for field in header.split(',')]
+
+        rows = []
+        for line in file:
+            fields = line.strip().split(',')
+            while len(fields) > 0 and fields[-1].strip() == '':
+                fields.pop()
+            if len(fields) == 0:
+                continue
+            rows.append([_parse_csv_value(field) for field in fields])
+
+    if len(rows) == 0:
+        return {name: np.empty(0) for name in names if name is not None}
+
+    width = min(len(row) for row in rows)
+    data = np.array([row[:width] for row in rows], dtype=np.float64)
+    columns = {name: data[:, idx] for idx, name in enumerate(names[:width]) if name is not None}
+
+    if 'time' not in columns:
+        columns = {'time': np.arange(len(data)) * RECORDER_PERIOD_S, **columns}
+    return columns
+
+def convert_csv(csv_path, out_path=None):
+    if out_path is None:
+        out_path = os.path.splitext(csv_path)[0] + '.trun'
+    columns = read_csv_run(csv_path)
+    write_run(out_path, columns, meta={'source': os.path.basename(csv_path)})
+    return out_path
+
+def export_archived_run(archive, run_id, out_path):
+    run = archive.get_run(run_id)
+    samples = np.array(archive.load_samples(run_id), dtype=np.float64).reshape(-1, 6)
+    columns = {
+        'time': samples[:, 0],
+        'adc': samples[:, 1],
+        'voltage': samples[:, 2],
+        'temp': samples[:, 3] / 1000.0,
+        'step': samples[:, 4],
+        'desired': samples[:, 5] / 1000.0,
+    }
+    meta = {key: run[key] for key in run.keys() if key != 'sample_file'}
+    write_run(out_path, columns, meta=meta)
+    return out_path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: toaster_runfile.py run.csv [run.csv ...]')
+        exit()
+
+    for path in sys.argv[1:]:
+        if path.endswith('.trun'):
+            with RunFile(path) as run:
+                print(f'{path}: {len(run)} samples, columns {run.columns}, meta {run.meta}')
+            continue
+        try:
+            print(f'{path} -> {convert_csv(path)}')
+        except (OSError, ValueError) as e:
+            print(f'Error converting {path}: {e}')
@@ -0,0 +1,113 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Opt-in tracing of host hot paths, exported as Chrome trace-event JSON
+# (open in chrome://tracing or ui.perfetto.dev).
+# Enable with enable('trace.json') or by setting TOASTER_TRACE=trace.json before starting a script.
+# When disabled, span() returns a shared no-op context manager and records nothing.
+
+MAX_EVENTS_PER_THREAD = 200000
+ENV_VAR = 'TOASTER_TRACE'
+
+enabled = False
+_start_ns = time.perf_counter_ns()
+_buffers = []
+_registry_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'detail', 'start_ns')
+
+    def __init__(self, name, detail):
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end_ns = time.perf_counter_ns()
+        _thread_buffer().append((self.name, self.start_ns, end_ns - self.start_ns, self.detail))
+        return False
+
+
+def _thread_buffer():
+    # Each thread appends only to its own bounded deque, the lock is taken once per thread to register it
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        buffer = deque(maxlen=MAX_EVENTS_PER_THREAD)
+        _local.buffer = buffer
+        thread = threading.current_thread()
+        with _registry_lock:
+            _buffers.append((thread.ident, thread.name, buffer))
+    return buffer
+
+def span(name, detail=None):
+    if not enabled:
+        return NULL_SPAN
+    return _Span(name, detail)
+
+def instant(name, detail=None):
+    if enabled:
+        _thread_buffer().append((name, time.perf_counter_ns(), None, detail))
+
+def enable(path=None):
+    global enabled
+    enabled = True
+    if path is not None:
+        atexit.register(export, path)
+
+def disable():
+    global enabled
+    enabled = False
+
+def clear():
+    with _registry_lock:
+        for _, _, buffer in _buffers:
+            buffer.clear()
+
+def events():
+    pid = os.getpid()
+    with _registry_lock:
+        buffers = list(_buffers)
+
+    trace_events = []
+    for tid, thread_name, buffer in buffers:
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+        for name, start_ns, dur_ns, detail in list(buffer):
+            event = {'name': name, 'pid': pid, 'tid': tid, 'ts': (start_ns - _start_ns) / 1000.0}
+            if dur_ns is None:
+                event['ph'] = 'i'
+                event['s'] = 't'
+            else:
+                event['ph'] = 'X'
+                event['dur'] = dur_ns / 1000.0
+            if detail is not None:
+                event['args'] = {'detail': detail.decode(errors='replace') if isinstance(detail, bytes) else str(detail)}
+            trace_events.append(event)
+    return trace_events
+
+def export(path):
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events(), 'displayTimeUnit': 'ms'}, file)
+    print(f'Trace written to {path}')
+
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
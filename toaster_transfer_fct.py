@@ -1,4 +1,5 @@
 from toaster_ctrl import Toaster
+from toaster_profile import upload_profile
 from tkinter import filedialog
 import matplotlib.pyplot as plt
 import time
@@ -69,7 +70,7 @@ def load_profile(args):
     return steps, stripped_name
 
 
-with Toaster(comport='COM3') as host:
+with Toaster() as host:
     host.begin_ctrl()
     host.set_gain(DEFAULT_GAIN)
     host.on(is_slow=True)
@@ -119,9 +120,10 @@ with Toaster(comport='COM3') as host:
             current_profile = loaded_profile
             profile_name = name
 
-            host.profile_clear()
-            for step in loaded_profile:
-                host.profile_add_point(step[0] * 1000, step[1])
+            if upload_profile(host, loaded_profile):
+                print('Profile set')
+            else:
+                print('Profile already loaded')
 
         elif command_id in Command_ID.RUN_PROFILE:
             start_index = len(all_data)
@@ -0,0 +1,185 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from toaster_model import ThermalModel
+from toaster_profile import read_profile, profile_duration, profile_setpoints
+
+# Replays the rev2 firmware's hysteresis control law against ThermalModel for many
+# (gain, hysteresis, relay mode) settings at once and ranks them by tracking error and
+# relay switch count. Each worker process steps a block of settings as one vectorized
+# simulation; blocks and profiles are fanned out across a process pool.
+
+# Settings currently used by the host scripts, always included for comparison
+BASELINE_SETTINGS = [(-150.0, 3.0, 'fast'), (-162.6, 3.0, 'fast')]
+
+# How the hysteresis output reaches the heater: the fast relay switches as the firmware does,
+# the slow relay has a switching delay and a minimum time between switches
+RELAY_MODES = {
+    'fast': {'delay_s': 0.0, 'min_dwell_s': 0.0},
+    'slow': {'delay_s': 0.5, 'min_dwell_s': 2.0},
+}
+
+GAIN_RANGE = (-180.0, -130.0)
+HYSTERESIS_RANGE = (0.5, 8.0)
+FIRMWARE_AVERAGING = 10
+FIRMWARE_LOOP_S = 0.001
+SIM_DT_S = FIRMWARE_AVERAGING * FIRMWARE_LOOP_S  # one control decision per averaged reading
+COOLDOWN_S = 30  # simulated after the profile so late relay switches are counted
+SWITCH_WEIGHT = 0.02  # degC of RMS error one relay switch is worth when ranking
+BLOCK_SIZE = 256
+
+
+def simulate(steps, gains, hysteresis, delay_s, min_dwell_s, model_params, dt=SIM_DT_S, seed=0):
+    model = ThermalModel(**model_params)
+    rng = np.random.default_rng(seed)
+    n = len(gains)
+
+    duration = profile_duration(steps)
+    times = np.arange(0.0, duration + COOLDOWN_S, dt)
+    desired = profile_setpoints(steps, times)
+    running = times < duration
+
+    state = model.initial_state(n)
+    averaged_noise = model.noise_degc / np.sqrt(FIRMWARE_AVERAGING)
+    command = np.zeros(n)
+    heater = np.zeros(n)
+    since_switch = np.full(n, np.inf)
+    switches = np.zeros(n, dtype=np.int64)
+
+    # Delayed actuation: ring buffer of past commands, one row per time step
+    delay_steps = np.round(delay_s / dt).astype(np.int64)
+    history = np.zeros((int(delay_steps.max()) + 1, n))
+    columns = np.arange(n)
+
+    sq_error = np.zeros(n)
+    max_overshoot = np.full(n, -np.inf)
+    max_undershoot = np.full(n, -np.inf)
+    n_running = 0
+
+    for k in range(len(times)):
+        if running[k]:
+            measured = model.measure(state, gains) + rng.normal(0.0, averaged_noise, size=n)
+            too_hot = measured > desired[k] + hysteresis
+            too_cold = measured < desired[k] - hysteresis
+            command = np.where(too_hot, 0.0, np.where(too_cold, 1.0, command))
+        else:
+            # End of the profile, the firmware turns the fast relay off
+            command = np.zeros(n)
+
+        history[k % len(history)] = command
+        requested = history[(k - delay_steps) % len(history), columns]
+        change = (requested != heater) & (since_switch >= min_dwell_s)
+        heater = np.where(change, requested, heater)
+        switches += change
+        since_switch = np.where(change, 0.0, since_switch + dt)
+
+        model.step(state, heater, dt)
+
+        if running[k]:
+            error = state[1] - desired[k]
+            sq_error += error * error
+            np.maximum(max_overshoot, error, out=max_overshoot)
+            np.maximum(max_undershoot, -error, out=max_undershoot)
+            n_running += 1
+
+    return {
+        'rms_error': np.sqrt(sq_error / max(n_running, 1)),
+        'max_overshoot': max_overshoot,
+        'max_undershoot': max_undershoot,
+        'switches': switches,
+    }
+
+def grid_settings(gains, hystereses, modes):
+    return [(gain, hysteresis, mode) for gain in gains for hysteresis in hystereses for mode in modes]
+
+def random_settings(n, modes, seed=0):
+    rng = np.random.default_rng(seed)
+    gains = rng.uniform(*GAIN_RANGE, size=n)
+    hystereses = rng.uniform(*HYSTERESIS_RANGE, size=n)
+    mode_choices = rng.choice(modes, size=n)
+    return [(float(g), float(h), str(m)) for g, h, m in zip(gains, hystereses, mode_choices)]
+
+def run_block(args):
+    profile_file, settings, model_params, seed = args
+    steps, _ = read_profile(profile_file)
+    gains = np.array([setting[0] for setting in settings])
+    hysteresis = np.array([setting[1] for setting in settings])
+    delay_s = np.array([RELAY_MODES[setting[2]]['delay_s'] for setting in settings])
+    min_dwell_s = np.array([RELAY_MODES[setting[2]]['min_dwell_s'] for setting in settings])
+    return profile_file, settings, simulate(steps, gains, hysteresis, delay_s, min_dwell_s, model_params, seed=seed)
+
+def sweep(profile_files, settings, model_params, workers=None, seed=0):
+    blocks = [settings[i:i + BLOCK_SIZE] for i in range(0, len(settings), BLOCK_SIZE)]
+    tasks = [(profile_file, block, model_params, seed) for profile_file in profile_files for block in blocks]
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for profile_file, block, metrics in executor.map(run_block, tasks):
+            for idx, setting in enumerate(block):
+                results.setdefault(setting, {})[profile_file] = {name: float(values[idx]) for name, values in metrics.items()}
+    return results
+
+def rank(results, switch_weight=SWITCH_WEIGHT):
+    ranked = []
+    for setting, per_profile in results.items():
+        rms_error = np.mean([metrics['rms_error'] for metrics in per_profile.values()])
+        switches = np.mean([metrics['switches'] for metrics in per_profile.values()])
+        overshoot = np.max([metrics['max_overshoot'] for metrics in per_profile.values()])
+        score = rms_error + switch_weight * switches
+        ranked.append((score, setting, rms_error, overshoot, switches))
+    ranked.sort(key=lambda row: row[0])
+    return ranked
+
+def print_ranking(ranked, top):
+    print(f'{"rank":>4}  {"gain":>8} {"hyst":>5} {"relay":<5} {"score":>7} {"rms (C)":>8} {"overshoot":>9} {"switches":>8}')
+    baseline_rows = [row for row in ranked if row[1] in BASELINE_SETTINGS]
+    shown = ranked[:top] + [row for row in baseline_rows if row not in ranked[:top]]
+    for row in shown:
+        score, (gain, hysteresis, mode), rms_error, overshoot, switches = row
+        marker = '  (current)' if row[1] in BASELINE_SETTINGS else ''
+        print(f'{ranked.index(row) + 1:>4}  {gain:>8.1f} {hysteresis:>5.2f} {mode:<5} {score:>7.2f} '
+              f'{rms_error:>8.2f} {overshoot:>9.2f} {switches:>8.0f}{marker}')
+
+def write_results(path, ranked):
+    with open(path, 'w') as csvfile:
+        csvfile.write('Gain, Hysteresis (C), Relay, Score, RMS error (C), Max overshoot (C), Switches\n')
+        for score, (gain, hysteresis, mode), rms_error, overshoot, switches in ranked:
+            csvfile.write(f'{gain}, {hysteresis}, {mode}, {score}, {rms_error}, {overshoot}, {switches}\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sweep gain, hysteresis and relay mode on a simulated oven')
+    parser.add_argument('profiles', nargs='*', help='profile files, defaults to profiles/*.csv')
+    parser.add_argument('--model', help='JSON file of ThermalModel parameters')
+    parser.add_argument('--random', type=int, metavar='N', help='random search with N settings instead of a grid')
+    parser.add_argument('--gains', type=float, nargs='+', default=list(np.linspace(*GAIN_RANGE, 11)))
+    parser.add_argument('--hysteresis', type=float, nargs='+', default=[0.5, 1, 1.5, 2, 3, 4, 5, 6, 8])
+    parser.add_argument('--modes', nargs='+', choices=list(RELAY_MODES), default=list(RELAY_MODES))
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--output', help='write the full ranking to this CSV file')
+    args = parser.parse_args()
+
+    profile_files = args.profiles or sorted(glob.glob(os.path.join('profiles', '*.csv')))
+    model_params = ThermalModel.from_file(args.model).params if args.model else ThermalModel().params
+
+    if args.random:
+        settings = random_settings(args.random, args.modes, seed=args.seed)
+    else:
+        settings = grid_settings(args.gains, args.hysteresis, args.modes)
+    settings += [setting for setting in BASELINE_SETTINGS if setting not in settings]
+
+    start = time.time()
+    results = sweep(profile_files, settings, model_params, workers=args.workers, seed=args.seed)
+    ranked = rank(results)
+    print(f'{len(settings)} settings x {len(profile_files)} profile(s) in {time.time() - start:.1f} s')
+    print_ranking(ranked, args.top)
+
+    if args.output:
+        write_results(args.output, ranked)